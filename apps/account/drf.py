@@ -1,5 +1,16 @@
+import hashlib
+import json
+
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
 from rest_framework.permissions import BasePermission
 from rest_framework.authentication import SessionAuthentication
+from rest_framework.pagination import CursorPagination
+from rest_framework.renderers import BaseRenderer
+from rest_framework.response import Response
+from rest_framework.serializers import ListSerializer
+
+from apps.host.models import ChangeCounter
 
 def is_sudo(request):
     hdr = int(request.META.get('HTTP_X_SUDO', 1))
@@ -25,4 +36,90 @@ class IsStaff(BasePermission):
 class CsrfExemptSessionAuthentication(SessionAuthentication):
 
     def enforce_csrf(self, request):
-        return  # To not perform the csrf check previously happening
\ No newline at end of file
+        return  # To not perform the csrf check previously happening
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets actions negotiate text/event-stream. They stream the events themselves,
+    this only renders errors as a single event.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return "event: error\ndata: %s\n\n" % json.dumps(data)
+
+
+class OptionalCursorPagination(CursorPagination):
+    """
+    Cursor pagination along the primary key, only if the client asks for it
+    with ?page_size= or ?cursor=. Lists stay unpaginated otherwise.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_size_query_param not in request.query_params and \
+                self.cursor_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class SparseFieldsMixin(object):
+    """
+    ?fields=a,b limits GET responses to these fields of the top level serializer
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        root = self.parent.parent if isinstance(self.parent, ListSerializer) else self.parent
+        request = self.context.get('request')
+        if root is None and request is not None and request.method == 'GET':
+            wanted = request.query_params.get('fields')
+            if wanted:
+                wanted = set(wanted.split(','))
+                for name in [name for name in fields if name not in wanted]:
+                    del fields[name]
+        return fields
+
+
+class ConditionalMixin(object):
+    """
+    ETag and Last-Modified for list and retrieve from the ChangeCounter of
+    `change_scope`. Matching conditional requests get a 304 before any
+    serialization. The ETag covers the user, the sudo header and the full path.
+    It is the only validator, If-Modified-Since is ignored as its whole seconds
+    miss the changes within the second of the last response.
+    """
+    change_scope = None
+
+    def conditional(self, request, respond, *args, **kwargs):
+        value, modified = ChangeCounter.current(self.change_scope)
+        key = "%s:%s:%s:%s" % (value, request.user.pk, is_sudo(request), request.get_full_path())
+        etag = '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        unchanged = etag in [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+
+        if unchanged:
+            if self.detail:
+                # the 404 and the object permissions apply as without the ETag
+                self.get_object()
+            response = Response(status=304)
+        else:
+            response = respond(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if modified is not None:
+                response['Last-Modified'] = http_date(modified.timestamp())
+        patch_vary_headers(response, ['Cookie', 'Authorization', 'X-Sudo'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(request, super().retrieve, *args, **kwargs)
@@ -4,8 +4,10 @@ from rest_framework import serializers
 
 from apps.container.models import Project
 
+from .drf import SparseFieldsMixin
 
-class UserSerializer(serializers.ModelSerializer):
+
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     approved = serializers.SerializerMethodField(read_only=False)
     superuser = serializers.SerializerMethodField()
 
@@ -20,7 +22,7 @@ class UserSerializer(serializers.ModelSerializer):
         return user.is_superuser
 
 
-class ProjectSerializer(serializers.ModelSerializer):
+class ProjectSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     containers = serializers.HyperlinkedRelatedField(source='container_set', many=True, view_name="container-detail", read_only=True)
     users = serializers.HyperlinkedRelatedField(many=True, view_name='user-detail', queryset=User.objects.all())
 
@@ -8,7 +8,7 @@ from rest_framework.viewsets import ModelViewSet
 
 from apps.container.models import Project
 
-from .drf import IsStaff, IsSuperuser, is_sudo
+from .drf import ConditionalMixin, IsStaff, IsSuperuser, is_sudo
 from .serializers import ProjectCreateSerializer, ProjectSerializer, UserSerializer
 from .proj_serializers import ProjectFatSerializer
 
@@ -60,7 +60,8 @@ class UserViewSet(ModelViewSet):
         return self._detail_user(request, instance)
 
 
-class ProjectViewSet(ModelViewSet):
+class ProjectViewSet(ConditionalMixin, ModelViewSet):
+    change_scope = 'project'
     serializer_class = ProjectSerializer
 
     def get_queryset(self):
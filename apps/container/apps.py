@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ContainerConfig(AppConfig):
     name = 'apps.container'
+
+    def ready(self):
+        from . import signals  # noqa: F401
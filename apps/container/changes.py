@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Max
+
+from .models import ContainerChange
+
+# changes per database poll
+BATCH = 500
+
+# seconds between comments which keep idle streams open through proxies
+KEEPALIVE = 15
+
+# milliseconds EventSource clients wait before reconnecting, after a stream ended
+# and when all stream slots were taken
+RETRY = 1000
+BUSY_RETRY = 5000
+
+# open streams of this process, see CONTAINER_EVENTS_STREAMS
+_streams = 0
+_lock = threading.Lock()
+
+
+def last_change():
+    """
+    id of the latest change, where clients without a position start
+    """
+    return ContainerChange.objects.aggregate(last=Max("id"))["last"] or 0
+
+
+def changes_after(changes, after):
+    return list(changes.filter(id__gt=after).order_by("id")[:BATCH])
+
+
+def wait_changes(changes, after, wait):
+    """
+    the changes after the id `after`, waits up to `wait` seconds for the first ones
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        found = changes_after(changes, after)
+        remaining = deadline - time.monotonic()
+        if found or remaining <= 0:
+            return found
+        time.sleep(min(getattr(settings, "CONTAINER_EVENTS_POLL"), remaining))
+
+
+def _take_slot():
+    global _streams
+    with _lock:
+        if _streams >= getattr(settings, "CONTAINER_EVENTS_STREAMS"):
+            return False
+        _streams += 1
+        return True
+
+
+def _free_slot():
+    global _streams
+    with _lock:
+        _streams -= 1
+
+
+def format_change(change):
+    return "id: %d\nevent: container\ndata: %s\n\n" % (change.id, json.dumps(change.as_event()))
+
+
+def stream_changes(changes, after):
+    """
+    text/event-stream of the changes after the id `after`. It ends after
+    CONTAINER_EVENTS_STREAM seconds, EventSource clients reconnect by themselves
+    and continue from the Last-Event-ID they got.
+
+    Every open stream holds a server thread, at most CONTAINER_EVENTS_STREAMS per
+    process. Beyond that the clients get the changes so far and poll again after
+    BUSY_RETRY.
+    """
+    if not _take_slot():
+        yield "retry: %d\n\n" % BUSY_RETRY
+        for change in changes_after(changes, after):
+            yield format_change(change)
+        return
+
+    try:
+        yield "retry: %d\n\n" % RETRY
+        started = idle = time.monotonic()
+        while time.monotonic() - started < getattr(settings, "CONTAINER_EVENTS_STREAM"):
+            found = changes_after(changes, after)
+            for change in found:
+                after = change.id
+                yield format_change(change)
+            if found:
+                idle = time.monotonic()
+                continue
+            if time.monotonic() - idle > KEEPALIVE:
+                idle = time.monotonic()
+                yield ": keepalive\n\n"
+            time.sleep(getattr(settings, "CONTAINER_EVENTS_POLL"))
+    finally:
+        # also when the client went away and the server closed the stream
+        _free_slot()
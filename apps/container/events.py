@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+
+from django.db import close_old_connections
+from django.db.models.functions import Now
+from pylxd.client import EventType
+from ws4py.client import WebSocketBaseClient
+
+from apps.host.lxd import get_client
+from apps.host.models import Host
+
+from .tasks import refresh_container
+
+# the logging events are chatty
+EVENT_TYPES = [EventType.Lifecycle, EventType.Operation]
+
+# success, failure, cancelled
+FINISHED = (200, 400, 401)
+
+
+def event_containers(event):
+    """
+    names of the containers a lifecycle or finished operation event is about
+    """
+    metadata = event.get("metadata") or {}
+    if event.get("type") == "lifecycle":
+        sources = [metadata.get("source") or ""]
+    elif event.get("type") == "operation" and metadata.get("status_code") in FINISHED:
+        resources = metadata.get("resources") or {}
+        sources = (resources.get("containers") or []) + (resources.get("instances") or [])
+    else:
+        return set()
+
+    names = set()
+    for source in sources:
+        # /1.0/containers/<name>[/snapshots/<snapshot>][?project=...]
+        parts = source.split("?")[0].split("/")
+        if len(parts) > 3 and parts[2] in ("containers", "instances"):
+            names.add(parts[3])
+    return names
+
+
+class EventListener(WebSocketBaseClient):
+    """
+    /1.0/events websocket of a host, refreshes the containers an event touches
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.host = None
+        self.client = None
+
+    def received_message(self, message):
+        try:
+            event = json.loads(message.data.decode('utf-8'))
+            for name in event_containers(event):
+                refresh_container(self.client, self.host, name)
+        except Exception as e:
+            print("%s: failed to handle event:" % self.host.name, e)
+        finally:
+            close_old_connections()
+
+
+def listen_host(host_id):
+    """
+    follows the event stream of a host until the host is removed. Reconnects on
+    errors and makes a full sync due on every connect to catch up on missed events.
+    """
+    while True:
+        close_old_connections()
+        host = Host.objects.filter(pk=host_id).first()
+        if host is None:
+            return
+
+        try:
+            client = get_client(host, timeout=60)
+            ws = client.events(websocket_client=EventListener, event_types=EVENT_TYPES)
+            ws.host = host
+            ws.client = client
+            ws.connect()
+            # let the scheduler sync the host to catch up
+            Host.objects.filter(id=host.id).update(next_sync=Now())
+            print("%s: listening for events" % host.name)
+            ws.run()
+            print("%s: event stream closed, reconnecting" % host.name)
+        except Exception as e:
+            print("%s: event stream failed, reconnecting:" % host.name, e)
+        time.sleep(5)
+
+
+def listen(rescan=60):
+    """
+    blocks forever with one listener thread per host, new hosts are picked up
+    every `rescan` seconds
+    """
+    threads = {}
+    while True:
+        for host_id in Host.objects.values_list("id", flat=True):
+            thread = threads.get(host_id)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=listen_host, args=(host_id,), daemon=True)
+                thread.start()
+                threads[host_id] = thread
+        close_old_connections()
+        time.sleep(rescan)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.container.events import listen
+
+
+class Command(BaseCommand):
+    help = "follow the LXD event streams of all hosts and keep the container states up to date, " \
+           "run it as a service and set LXD_EVENTS=True for the workers and beat"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rescan", type=int, default=60, help="seconds between checks for new hosts")
+
+    def handle(self, *args, **options):
+        listen(rescan=options["rescan"])
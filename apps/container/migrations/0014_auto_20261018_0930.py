@@ -0,0 +1,23 @@
+# Generated by Django 3.0.6 on 2026-10-18 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0013_auto_20210427_1047'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='container',
+            name='counters_updated',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='container',
+            name='state_digest',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
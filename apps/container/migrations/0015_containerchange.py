@@ -0,0 +1,24 @@
+# Generated by Django 3.0.6 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0014_auto_20261018_0930'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContainerChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('container_pk', models.IntegerField()),
+                ('project_pk', models.IntegerField(null=True)),
+                ('action', models.CharField(choices=[('update', 'update'), ('delete', 'delete')], max_length=10)),
+                ('data', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.0.6 on 2026-10-18 15:00
+
+import json
+
+from django.db import migrations, models
+
+
+def fill_state_columns(apps, schema_editor):
+    """
+    copy status code and usage out of the stored states, as Container.set_state_columns
+    """
+    Container = apps.get_model('container', 'Container')
+    batch = []
+    for ct in Container.objects.only("id", "state").iterator():
+        try:
+            state = json.loads(ct.state)
+        except Exception:
+            state = None
+        if not isinstance(state, dict):
+            state = {}
+        try:
+            ct.status_code = int(state.get("status_code", 400))
+        except (TypeError, ValueError):
+            ct.status_code = 400
+        ct.memory_usage = (state.get("memory") or {}).get("usage")
+        ct.cpu_usage = (state.get("cpu") or {}).get("usage")
+        ct.processes = state.get("processes")
+        batch.append(ct)
+        if len(batch) >= 500:
+            Container.objects.bulk_update(batch, ["status_code", "memory_usage", "cpu_usage", "processes"])
+            batch = []
+    Container.objects.bulk_update(batch, ["status_code", "memory_usage", "cpu_usage", "processes"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('container', '0015_containerchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='container',
+            name='cpu_usage',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='container',
+            name='memory_usage',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='container',
+            name='processes',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='container',
+            name='status_code',
+            field=models.IntegerField(default=400),
+        ),
+        migrations.RunPython(fill_state_columns, migrations.RunPython.noop),
+    ]
@@ -5,6 +5,7 @@ import gitlab
 
 from django.contrib.auth.models import User
 from django.db import models, transaction
+from django.db.models import Q
 from django.db.models.functions import Now
 from django.conf import settings
 from fernet_fields import EncryptedTextField
@@ -51,6 +52,14 @@ class Container(models.Model):
     state = models.TextField(null=True, blank=True)
     state_version = models.DateTimeField(null=True)
     config = models.TextField(null=True, blank=True)
+    # digest of the state without usage counters and of the config, as last synced
+    state_digest = models.CharField(max_length=40, null=True, blank=True)
+    counters_updated = models.DateTimeField(null=True)
+    # copied from the state, for aggregates in the database
+    status_code = models.IntegerField(default=400)
+    memory_usage = models.BigIntegerField(null=True)
+    cpu_usage = models.BigIntegerField(null=True)
+    processes = models.IntegerField(null=True)
 
     target_status_code = models.IntegerField(null=True, blank=True)
 
@@ -69,12 +78,26 @@ class Container(models.Model):
             print(e)
             return False
 
-    @property
-    def status_code(self):
+    STATE_COLUMNS = ("status_code", "memory_usage", "cpu_usage", "processes")
+
+    def set_state_columns(self, state=None):
+        """
+        copy status code and usage from the LXD state dict, parsed from .state if None
+        """
+        if state is None:
+            try:
+                state = json.loads(self.state)
+            except Exception:
+                state = None
+        if not isinstance(state, dict):
+            state = {}
         try:
-            return json.loads(self.state).get("status_code", 400)
-        except Exception:
-            return 400
+            self.status_code = int(state.get("status_code", 400))
+        except (TypeError, ValueError):
+            self.status_code = 400
+        self.memory_usage = (state.get("memory") or {}).get("usage")
+        self.cpu_usage = (state.get("cpu") or {}).get("usage")
+        self.processes = state.get("processes")
 
     @transaction.atomic
     def save(self, *args, **kw):
@@ -82,16 +105,31 @@ class Container(models.Model):
             orig = Container.objects.get(pk=self.pk)
             if orig.state != str(self.state):
                 self.state_version = Now()
+                self.state_digest = None
+        self.config = Container.mask_config(self.config)
+        self.set_state_columns()
+        super(Container, self).save(*args, **kw)
+
+    @staticmethod
+    def mask_config(config):
+        """
+        json config with the vendor data (private host keys) masked
+        """
         try:
-            conf = json.loads(self.config)
+            conf = json.loads(config)
             if 'user.vendor-data' in conf:
                 conf['user.vendor-data'] = '****'
-            self.config = json.dumps(conf)
+            return json.dumps(conf)
         except Exception:
-            pass
-        super(Container, self).save(*args, **kw)
+            return config
 
     def get_all_ips(self):
+        prefetched = getattr(self, "_prefetched_objects_cache", {})
+        if "ip_set" in prefetched and "target_ip" in prefetched:
+            # merge the prefetched relations instead of a query per container
+            ips = dict((ip.pk, ip) for ip in self.ip_set.all())
+            ips.update((ip.pk, ip) for ip in self.target_ip.all())
+            return [ips[pk] for pk in sorted(ips)]
         return self.ip_set.all() | self.target_ip.all()
 
     def get_host_key_config(self):
@@ -201,3 +239,49 @@ class IP(models.Model):
     @property
     def is_ipv4(self):
         return type(self.get_interface()) == IPv4Interface
+
+
+class ContainerChange(models.Model):
+    """
+    State, target status and addresses of a container after a change, the feed
+    of the container event stream. Old rows are pruned by prune_changes.
+    """
+    UPDATE = "update"
+    DELETE = "delete"
+    ACTIONS = ((UPDATE, 'update'), (DELETE, 'delete'))
+
+    # no foreign keys, the rows outlive their container and project
+    container_pk = models.IntegerField()
+    project_pk = models.IntegerField(null=True)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @classmethod
+    def record(cls, containers, action=UPDATE):
+        """
+        store the current state of containers once the current transaction commits
+        """
+        containers = [c for c in containers if c.pk is not None]
+        if not containers:
+            return
+
+        ips = {}
+        if action == cls.UPDATE:
+            for ip, ct, target in IP.objects.filter(Q(container__in=containers) | Q(container_target__in=containers)) \
+                    .values_list("ip", "container_id", "container_target_id"):
+                for pk in {ct, target} - {None}:
+                    ips.setdefault(pk, set()).add(ip)
+
+        changes = [cls(container_pk=c.pk, project_pk=c.project_id, action=action,
+                       data=json.dumps({"name": c.name, "host": c.host_id, "status_code": c.status_code,
+                                        "target_status_code": c.target_status_code,
+                                        "ips": sorted(ips.get(c.pk, []))}))
+                   for c in containers]
+        transaction.on_commit(lambda: cls.objects.bulk_create(changes))
+
+    def as_event(self):
+        event = json.loads(self.data)
+        event.update(event=self.id, action=self.action, id=self.container_pk, project=self.project_pk,
+                     created=self.created.isoformat())
+        return event
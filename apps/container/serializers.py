@@ -5,7 +5,7 @@ from django.utils.crypto import get_random_string
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 
-from apps.account.drf import is_sudo
+from apps.account.drf import SparseFieldsMixin, is_sudo
 from apps.account.serializers import MyProjectSlimSerializer, MyProjectLinkSerializer
 from apps.host.models import Host
 from apps.host.serializers import HostSerializer, HostSlimSerializer
@@ -43,7 +43,7 @@ class MySIITSerializer(serializers.HyperlinkedRelatedField):
         return queryset.exclude(id__in=legacy)
 
 
-class IPSerializer(serializers.ModelSerializer):
+class IPSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     container_target = MyContainerSerializer(view_name='container-detail', required=False, allow_null=True)
     siit_map = MySIITSerializer(view_name='ip-detail', required=False, allow_null=True)
     container = serializers.HyperlinkedRelatedField(view_name="container-detail", read_only=True)
@@ -76,7 +76,7 @@ class HostkeySerializer(serializers.ModelSerializer):
         fields = ('type', 'public')
 
 
-class ContainerSerializer(serializers.ModelSerializer):
+class ContainerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     ips = IPSerializer(source='get_all_ips', many=True, read_only=True)
     state = serializers.JSONField(read_only=True, allow_null=True)
     project = MyProjectLinkSerializer(required=False, allow_null=True, view_name='project-detail')
@@ -0,0 +1,61 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from apps.dns.notify import publish
+from apps.host.models import ChangeCounter
+
+from .models import IP, Container, ContainerChange, Hostkey, Project
+
+# API lists showing the rows of each model, see ChangeCounter. The image list
+# nests its hosts with their used memory, which the containers add up to.
+CONTAINER_SCOPES = ("container", "host", "project", "ip", "image")
+IP_SCOPES = ("ip", "container")
+PROJECT_SCOPES = ("project", "container")
+
+
+def ip_containers(ip):
+    ids = {ip.container_id, ip.container_target_id} - {None}
+    return Container.objects.filter(pk__in=ids) if ids else []
+
+
+@receiver(post_save, sender=Container)
+def container_saved(sender, instance, created, **kwargs):
+    ChangeCounter.bump(*CONTAINER_SCOPES)
+    ContainerChange.record([instance])
+    # only the name and the ips matter for DNS, state updates are not interesting
+    if created:
+        publish("container", instance.pk, "save")
+
+
+@receiver(post_delete, sender=Container)
+def container_deleted(sender, instance, **kwargs):
+    ChangeCounter.bump(*CONTAINER_SCOPES)
+    ContainerChange.record([instance], ContainerChange.DELETE)
+    publish("container", instance.pk, "delete")
+
+
+@receiver(post_save, sender=IP)
+def ip_saved(sender, instance, **kwargs):
+    ChangeCounter.bump(*IP_SCOPES)
+    ContainerChange.record(ip_containers(instance))
+    publish("ip", instance.pk, "save")
+
+
+@receiver(post_delete, sender=IP)
+def ip_deleted(sender, instance, **kwargs):
+    ChangeCounter.bump(*IP_SCOPES)
+    ContainerChange.record(ip_containers(instance))
+    publish("ip", instance.pk, "delete")
+
+
+@receiver(post_save, sender=Hostkey)
+@receiver(post_delete, sender=Hostkey)
+def hostkey_changed(sender, instance, **kwargs):
+    ChangeCounter.bump("container")
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(m2m_changed, sender=Project.users.through)
+def project_changed(sender, instance, **kwargs):
+    ChangeCounter.bump(*PROJECT_SCOPES)
@@ -1,156 +1,430 @@
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
 import json
-import urllib3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from ipaddress import ip_interface, IPv6Interface
 
 from celery import shared_task
 from django.conf import settings
-from django.db import DatabaseError, transaction
+from django.db import transaction
+from django.db.models import F, Q
 from django.db.models.functions import Now
 from django.utils.text import slugify
-from pylxd import Client
 from pylxd.exceptions import LXDAPIException, NotFound
-from pylxd import models
 
-from apps.container.models import IP, Container
-from apps.host.models import Host, Image
+from apps.container.models import IP, Container, ContainerChange
+from apps.container.signals import CONTAINER_SCOPES, IP_SCOPES
+from apps.dns.notify import publish
+from apps.host.locks import Lease, LeaseLost, backend
+from apps.host.lxd import get_client
+from apps.host.models import ChangeCounter, Host
+from apps.host.tasks import sync_images
+
+
+def fetch_state(ct):
+    """
+    name, state and expanded config of a container, None if it vanished meanwhile
+    """
+    try:
+        return ct.name, ct.api.state.get().json()['metadata'], ct.expanded_config
+    except NotFound:
+        return None
+
+
+def collect_states(client):
+    """
+    fetch the state of all containers of a host with LXD_SYNC_CONCURRENCY requests in flight
+    """
+    cts = client.containers.all()
+    with ThreadPoolExecutor(max_workers=getattr(settings, "LXD_SYNC_CONCURRENCY")) as pool:
+        return [s for s in pool.map(fetch_state, cts) if s is not None]
+
+
+def collect_states_bulk(client):
+    """
+    state and expanded config of all containers from a single recursion=2 listing,
+    None if the server does not support it
+    """
+    try:
+        metadata = client.api.containers.get(params={"recursion": 2}).json()['metadata']
+    except LXDAPIException:
+        return None
+    # older servers ignore the recursion level and answer with urls or without state
+    if not all(isinstance(ct, dict) and ct.get("state") is not None and "expanded_config" in ct for ct in metadata):
+        return None
+    return ((ct["name"], ct["state"], ct["expanded_config"]) for ct in metadata)
+
+
+DELETED_STATE = json.dumps({'status': 'Deleted', 'status_code': 113})
+
+# parts of the LXD state which change on every sync
+VOLATILE_STATE = ("cpu", "memory", "disk", "processes")
+
+
+def global_ips(state):
+    """
+    ip -> interface of the global addresses of a running container
+    """
+    ips = {}
+    for ifname, ifstate in (state.get("network") or {}).items():
+        if ifstate['state'] == 'up':
+            for ifaddr in ifstate["addresses"]:
+                ipif = ip_interface("%s/%s" % (ifaddr["address"], ifaddr["netmask"]))
+                if ipif.is_global:
+                    ips["%s" % ipif.ip] = ipif
+    return ips
+
+
+def state_digest(state, config):
+    """
+    digest of a container state without the usage counters and of its json config
+    """
+    stable = dict((k, v) for k, v in state.items() if k not in VOLATILE_STATE)
+    stable["network"] = dict((ifname, dict((k, v) for k, v in ifstate.items() if k != "counters"))
+                             for ifname, ifstate in (state.get("network") or {}).items())
+    return hashlib.sha1(json.dumps([stable, config], sort_keys=True).encode()).hexdigest()
+
+
+def fence(host, token):
+    """
+    record the token of the sync lock as the last writer of host, raises LeaseLost
+    if a later holder wrote already. The row stays locked until the transaction ends.
+    """
+    if not Host.objects.filter(id=host.id, sync_token__lte=token).update(sync_token=token):
+        raise LeaseLost("sync:%s" % host.id)
+
+
+@transaction.atomic
+def apply_states(host, states, complete=False, token=None):
+    """
+    store the (name, state, config) tuples of containers on host, returns whether
+    anything besides the usage counters changed.
+
+    Existing rows are loaded at once, diffed in memory and written with bulk
+    queries. Containers with an unchanged state digest are skipped, only their
+    usage counters are written every LXD_COUNTERS_INTERVAL. With complete,
+    containers missing in states are flagged deleted and removed once they stayed
+    deleted for 10 minutes, and the addresses of all running containers are
+    reconciled instead of only those of changed ones.
+    A token of the sync lock fences off writes of holders which lost the lock.
+    """
+    if token is not None:
+        fence(host, token)
+
+    now = datetime.now(timezone.utc)
+    existing = {c.name: c for c in host.container_set.all()}
+
+    counters_due = now - timedelta(seconds=getattr(settings, "LXD_COUNTERS_INTERVAL"))
+
+    created = []
+    changed = []
+    counters = []
+    running = {}
+    for name, state, config in states:
+        c = existing.get(name)
+        if c is None:
+            c = Container(name=name, host=host, state_version=now)
+            created.append(c)
+
+        state_str = json.dumps(state)
+        config_str = Container.mask_config(json.dumps(config))
+        digest = state_digest(state, config_str)
+        target = c.target_status_code
+        try:
+            if int(state["status_code"]) == c.target_status_code:
+                print("%s :reached status code" % c.name)
+                target = None
+        except Exception as e:
+            print("%s :failed on "%c, e)
+            pass
+
+        modified = c.pk is None or c.state_digest != digest
+        if modified or c.target_status_code != target:
+            if c.pk is not None:
+                if c.state_digest != digest:
+                    c.state_version = now
+                changed.append(c)
+            c.state = state_str
+            c.set_state_columns(state)
+            c.config = config_str
+            c.state_digest = digest
+            c.target_status_code = target
+            c.counters_updated = now
+        elif c.state != state_str and (c.counters_updated is None or c.counters_updated < counters_due):
+            # only the usage counters moved
+            c.state = state_str
+            c.set_state_columns(state)
+            c.counters_updated = now
+            counters.append(c)
+        if int(state["status_code"]) == 103 and (modified or complete): # only running contianers
+            running[name] = global_ips(state)
+
+    stale = []
+    if complete:
+        seen = set(name for name, state, config in states)
+        for c in existing.values():
+            if c.name in seen or c.status_code == 114:
+                continue
+            if c.state != DELETED_STATE:
+                c.state = DELETED_STATE
+                c.set_state_columns()
+                c.state_digest = None
+                c.state_version = now
+                changed.append(c)
+            elif c.state_version is None or c.state_version < now - timedelta(minutes=10):
+                # delete old stale
+                stale.append(c.pk)
+
+    if created:
+        Container.objects.bulk_create(created)
+        # not every backend returns the primary keys of bulk inserts
+        created = list(host.container_set.filter(name__in=[c.name for c in created]))
+        for c in created:
+            existing[c.name] = c
+    Container.objects.bulk_update(changed, ["state", "state_version", "config", "state_digest",
+                                            "target_status_code", "counters_updated"] + list(Container.STATE_COLUMNS))
+    Container.objects.bulk_update(counters, ["state", "counters_updated"] + list(Container.STATE_COLUMNS))
+    if stale:
+        Container.objects.filter(pk__in=stale).delete()
+
+    ips_changed = sync_ips(dict((existing[name], ips) for name, ips in running.items()))
+
+    # for the event stream, the usage counters alone are not worth an event,
+    # the deletion of the stale containers is recorded by their signals
+    touched = set(c.pk for c in created + changed) | ips_changed
+    ContainerChange.record(c for c in existing.values() if c.pk in touched)
+
+    # bulk queries send no signals
+    if created or stale or ips_changed:
+        # tell the DNS server about the changes of the host
+        publish("host", host.pk, "sync")
+    if created or changed or counters or stale:
+        ChangeCounter.bump(*CONTAINER_SCOPES)
+    elif ips_changed:
+        ChangeCounter.bump(*IP_SCOPES)
+
+    return bool(created or changed or stale or ips_changed)
+
+
+def sync_ips(running):
+    """
+    attach the global addresses to the running containers of {container: {ip: interface}},
+    IPv4 addresses no longer in use are detached, IPv6 ones are deleted.
+    Returns the primary keys of the containers whose addresses changed.
+    """
+    if not running:
+        return set()
+
+    wanted = {}
+    for c, ips in running.items():
+        for ip, ipif in ips.items():
+            wanted[ip] = (c, ipif)
+
+    created = []
+    changed = []
+    detach = []
+    delete = []
+    known = set()
+    touched = set()
+    for ip in IP.objects.filter(Q(ip__in=list(wanted)) | Q(container__in=list(running))):
+        if ip.ip in wanted:
+            c, ipif = wanted[ip.ip]
+            known.add(ip.ip)
+            target = c.pk if isinstance(ipif, IPv6Interface) else ip.container_target_id
+            if (ip.container_id, ip.container_target_id, ip.prefixlen) != (c.pk, target, ipif.network.prefixlen):
+                touched.update((ip.container_id, ip.container_target_id, c.pk))
+                ip.container_id = c.pk
+                ip.container_target_id = target
+                ip.prefixlen = ipif.network.prefixlen
+                changed.append(ip)
+        elif ip.is_ipv4:
+            detach.append(ip.pk)
+            touched.add(ip.container_id)
+        else:
+            delete.append(ip.pk)
+            touched.update((ip.container_id, ip.container_target_id))
+
+    for ip, (c, ipif) in wanted.items():
+        if ip not in known:
+            touched.add(c.pk)
+            created.append(IP(ip=ip, prefixlen=ipif.network.prefixlen, container=c,
+                              container_target=c if isinstance(ipif, IPv6Interface) else None))
+
+    IP.objects.bulk_create(created)
+    IP.objects.bulk_update(changed, ["container", "container_target", "prefixlen"])
+    if detach:
+        IP.objects.filter(pk__in=detach).update(container=None)
+    if delete:
+        IP.objects.filter(pk__in=delete).delete()
+    return touched - {None}
+
+
+def mark_deleted(c):
+    """
+    flag a container which is gone on its host, containers still being created are left alone
+    """
+    if c.status_code != 114:
+        c.state = DELETED_STATE
+        c.save()
+
+
+def refresh_container(client, host, name):
+    """
+    refetch a single container of host, e.g. after an LXD event. Takes the sync
+    lock of the host like synchost and fetches only then, so it neither races the
+    inserts of a sync nor writes a state older than the one a sync wrote. Waits
+    for a running sync up to LXD_SYNC_LEASE seconds, it fetched the state then.
+    """
+    lease = Lease("sync:%s" % host.pk, getattr(settings, "LXD_SYNC_LEASE"))
+    deadline = time.monotonic() + getattr(settings, "LXD_SYNC_LEASE")
+    while not lease.acquire():
+        if time.monotonic() > deadline:
+            print("%s: sync still running, skipping the refresh of %s" % (host.name, name))
+            return
+        time.sleep(0.5)
+
+    try:
+        try:
+            state = fetch_state(client.containers.get(name))
+        except NotFound:
+            state = None
+        with transaction.atomic():
+            if state is None:
+                fence(host, lease.token)
+                for c in host.container_set.filter(name=name):
+                    mark_deleted(c)
+            else:
+                apply_states(host, [state], token=lease.token)
+    except LeaseLost:
+        print("%s: lost the lock while refreshing %s" % (host.name, name))
+    finally:
+        lease.release()
+
+
+def sync_queue(host):
+    """
+    celery queue for the syncs of host, None for the default queue
+    """
+    slow = getattr(settings, "LXD_SYNC_SLOW_QUEUE")
+    if slow and (host.last_sync_duration or 0) > getattr(settings, "LXD_SYNC_SLOW"):
+        return slow
+    queues = getattr(settings, "LXD_SYNC_QUEUES")
+    if queues:
+        return queues[host.pk % len(queues)]
+    return None
+
+
+def next_interval(host, duration, changed):
+    """
+    seconds until the next sync of host: halved after a sync which changed
+    something, grown by half otherwise
+    """
+    interval = host.sync_interval or getattr(settings, "LXD_SYNC_INTERVAL")
+    interval = interval / 2 if changed else interval * 1.5
+    interval = max(interval, duration * getattr(settings, "LXD_SYNC_DUTY"), getattr(settings, "LXD_SYNC_INTERVAL_MIN"))
+    return int(min(interval, getattr(settings, "LXD_SYNC_INTERVAL_MAX")))
+
+
+def sync_soon(*host_ids):
+    """
+    make the hosts due for the next synclxd run, e.g. after an action changed their containers
+    """
+    Host.objects.filter(pk__in=host_ids).update(next_sync=Now())
 
 
 @shared_task
 def synchost(host_id):
     host = Host.objects.get(pk=host_id)
 
+    lease = Lease("sync:%s" % host_id, getattr(settings, "LXD_SYNC_LEASE"))
+    if not lease.acquire():
+        print("already processing %s (abort)" % host.name)
+        return
+
+    Host.objects.filter(id=host_id).update(sync_started=Now())
+    started = time.monotonic()
+    changed = False
     try:
-        syncing = False
-        h = None
-        with transaction.atomic():
-            try:
-                h = Host.objects.select_for_update(nowait=True).get(id=host_id)
-                if h.syncing is not None:
-                    syncing = True
-                    if h.syncing < datetime.now(timezone.utc) - timedelta(minutes=3):
-                        print("%s: remove stale lock" % host.name )
-                        syncing = False
-                        h.syncing = Now()
-                        h.save()
-                else:
-                    h.syncing = Now()
-                    h.save()
-            except DatabaseError:
-                syncing = True
-
-        if syncing:
-            print("already processing %s (abort), started: %s" % (host.name, h.syncing))
-            return
+        client = get_client(host, timeout=60)
 
-        client = Client(endpoint=host.api_url, cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")),
-                        verify=getattr(settings, "LXD_CA_CERT"), timeout=60)
-
-        if not getattr(settings, "LXD_CA_CERT"):
-            urllib3.disable_warnings()
-
-        existingcts = []
-        for ct in client.containers.all():
-            c = Container.objects.get_or_create(name=ct.name, host=host)[0]
-            existingcts.append(c)
-
-            existingips = []
-            c.state = json.dumps(ct.api.state.get().json()['metadata'])
-            c.config = json.dumps(ct.expanded_config)
-            try:
-                if int(json.loads(c.state)["status_code"]) == c.target_status_code:
-                    print("%s :reached status code" % c.name)
-                    c.target_status_code = None
-            except Exception as e:
-                print("%s :failed on "%c, e)
-                pass
-            c.save()
-            if int(json.loads(c.state)["status_code"]) == 103: # only running contianers
-                try:
-                    #if hasattr(ct.state(), "network") and ct.state().network is not None:
-                    for ifname, ifstate in ct.state().network.items():
-                        if ifstate['state'] == 'up':
-                            for ifaddr in ifstate["addresses"]:
-                                ipif = ip_interface("%s/%s" % (ifaddr["address"], ifaddr["netmask"]))
-                                if ipif.is_global:
-                                    ip = IP.objects.get_or_create(ip="%s" % ipif.ip, prefixlen=ipif.network.prefixlen)[0]
-                                    ip.container = c
-                                    if isinstance(ipif, IPv6Interface):
-                                        ip.container_target = c
-                                    ip.save()
-                                    existingips.append(ip)
-                except AttributeError:
-                    pass
-                for i in c.ip_set.all():
-                    if i not in existingips:
-                        if i.is_ipv4:
-                            i.container = None
-                            i.save()
-                        else:
-                            i.delete()
-
-        for c in host.container_set.all():
-            if c not in existingcts:
-                if c.status_code != 114:
-                    c.state = json.dumps({'status': 'Deleted', 'status_code': 113})
-                    c.save()
-
-                    # delete old stale
-                    if not isinstance(c.state_version, Now):
-                        if c.state_version < datetime.now(timezone.utc) - timedelta(minutes=10):
-                            c.delete()
-
-        fingerprints = []
-        available_aliases = []
-        for image in client.images.all():
-            # check for aliases
-
-            io = Image.objects.get_or_create(properties=json.dumps(image.properties), fingerprint=image.fingerprint)[0]
-            io.available.add(host)
-            if io.remove:
-                image: models.image.Image
-                image.delete()
-            else:
-                available_aliases += [a['name'] for a in image.aliases]
-                fingerprints.append(image.fingerprint)
-
-        for image in Image.objects.all():
-            if image.fingerprint not in fingerprints:
-                image.available.remove(host)
-            if image.sync and image.alias not in available_aliases:
-                # bring it there
-                try:
-                    if image.protocol == Image.SIMPLESTREAMS:
-                        client.images.create_from_simplestreams(image.server, alias=None, new_alias=image.alias, public=False, auto_update=True)
-                    else:
-                        client.images.create_from_image(image.server, alias=image.alias, public=False, auto_update=True)
-                except:
-                    pass
+        states = collect_states_bulk(client)
+        if states is None:
+            states = collect_states(client)
+
+        changed = apply_states(host, list(states), complete=True, token=lease.token)
+
+        lease.check()
+        sync_images(client, host)
 
         print("finished syncing %s" % host.name)
-        h.syncing = None
-        h.save()
 
     except LXDAPIException:
-        h.syncing = None
-        h.save()
-        return
+        pass
+
+    except LeaseLost:
+        print("lost the lock while syncing %s" % host.name)
+
+    finally:
+        # only while the lease is ours and no later holder wrote (fencing), the
+        # schedule belongs to the next holder otherwise. Queryset updates, saving
+        # the host would drop its cached clients.
+        # The interval counts from the claim, synclxd only looks on its beat ticks and
+        # a host due just after a tick would wait for another one.
+        if lease.valid():
+            duration = time.monotonic() - started
+            interval = next_interval(host, duration, changed)
+            claimed = host.sync_queued or datetime.now(timezone.utc)
+            Host.objects.filter(id=host_id, sync_token__lte=lease.token).update(
+                sync_queued=None, sync_started=None, last_sync_duration=duration, sync_interval=interval,
+                next_sync=claimed + timedelta(seconds=interval))
+        else:
+            print("lost the lock of %s, leaving its schedule to the next sync" % host.name)
+        lease.release()
 
 
 @shared_task
 def synclxd():
-    for host in Host.objects.all():
-        synchost.delay(host.id)
+    """
+    queue the syncs of the hosts which are due, most overdue first. A host is not
+    queued again while its sync is in flight, unless the sync stayed in the queue for
+    LXD_SYNC_QUEUE_TIMEOUT without starting or its worker died after it started, i.e.
+    its lease ran out. A long sync still holding its lease is left alone.
+    """
+    now = datetime.now(timezone.utc)
+    lost = now - timedelta(seconds=getattr(settings, "LXD_SYNC_QUEUE_TIMEOUT"))
+
+    leased = now - timedelta(seconds=getattr(settings, "LXD_SYNC_LEASE"))
+    for host in Host.objects.filter(sync_queued__isnull=False, sync_started__lt=leased):
+        if not backend().held("sync:%s" % host.id):
+            print("sync of %s died, queueing it again" % host.name)
+            Host.objects.filter(id=host.id, sync_started=host.sync_started).update(sync_queued=None,
+                                                                                   sync_started=None)
+    due = Host.objects.filter(Q(next_sync__isnull=True) | Q(next_sync__lte=now),
+                              Q(sync_queued__isnull=True) | Q(sync_queued__lt=lost, sync_started__isnull=True))
+    for host in due.order_by(F("next_sync").asc(nulls_first=True)):
+        # claim the host, a concurrent run does not see the old sync_queued anymore
+        if Host.objects.filter(id=host.id, sync_queued=host.sync_queued).update(sync_queued=now, sync_started=None):
+            synchost.apply_async((host.id,), queue=sync_queue(host))
+
+
+@shared_task
+def prune_changes():
+    """
+    drop the container changes older than CONTAINER_EVENTS_KEEP seconds
+    """
+    keep = timedelta(seconds=getattr(settings, "CONTAINER_EVENTS_KEEP"))
+    ContainerChange.objects.filter(created__lt=datetime.now(timezone.utc) - keep).delete()
 
 
 @shared_task
 def create_container(container_id):
+    ct = None
     try:
         ct = Container.objects.get(pk=container_id)
-        client = Client(endpoint=ct.host.api_url,
-                        cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")), verify=getattr(settings, "LXD_CA_CERT"))
+        client = get_client(ct.host)
 
         configs = {}
         configs.update(ct.get_host_key_config())
@@ -166,15 +440,18 @@ def create_container(container_id):
         client.containers.create(conf, wait=False)
     except Exception as e:
         print(e)
+    finally:
+        if ct is not None:
+            sync_soon(ct.host_id)
 
 
 @shared_task
 def delete_container(container_id):
+    ct = None
     try:
         ct = Container.objects.get(pk=container_id)
 
-        client = Client(endpoint=ct.host.api_url,
-                        cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")), verify=getattr(settings, "LXD_CA_CERT"))
+        client = get_client(ct.host)
 
         try:
             lct = client.containers.get(ct.name)
@@ -185,26 +462,32 @@ def delete_container(container_id):
         ct.delete()
     except Exception as e:
         print(e)
+    finally:
+        if ct is not None:
+            sync_soon(ct.host_id)
 
 
 @shared_task
 def container_action(container_id, action):
+    co = None
     try:
         co = Container.objects.get(pk=container_id)
-        client = Client(endpoint=co.host.api_url,
-                        cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")), verify=getattr(settings, "LXD_CA_CERT"))
+        client = get_client(co.host)
 
         ct = client.containers.get(co.name)
 
         if action in ["start", "stop", "restart"]:
-            getattr(ct, action)()
+            # the sync afterwards sees the final state
+            getattr(ct, action)(wait=True)
 
     except Exception as e:
         print(e)
+    finally:
+        if co is not None:
+            sync_soon(co.host_id)
 
 def reload_cloud_init(co, conf, restart=True):
-    client = Client(endpoint=co.host.api_url, cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")),
-                    verify=getattr(settings, "LXD_CA_CERT"))
+    client = get_client(co.host)
 
     ct = client.containers.get(co.name)
     try:
@@ -217,6 +500,7 @@ def reload_cloud_init(co, conf, restart=True):
     ct.save()
     if restart:
         ct.restart()
+    sync_soon(co.host_id)
 
 
 @shared_task
@@ -241,20 +525,21 @@ def container_migrate(container_id, srchost_id):
     co = Container.objects.get(pk=container_id)
     srchost = Host.objects.get(pk=srchost_id)
 
-    client_source = Client(endpoint=srchost.api_url, cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")),
-                    verify=getattr(settings, "LXD_CA_CERT"))
-    client_destination = Client(endpoint=co.host.api_url, cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")),
-                    verify=getattr(settings, "LXD_CA_CERT"))
+    client_source = get_client(srchost)
+    client_destination = get_client(co.host)
     cont = client_source.containers.get(co.name)
 
-    state = cont.api.state.get().json()['metadata']["status_code"]
-    was_running = False
-    if int(state) != 102:
-        if int(state) == 103:
-            was_running = True
-        cont.stop(wait=True)
-    cont.migrate(client_destination, wait=True)
-
-    if was_running:
-        cont = client_destination.containers.get(co.name)
-        cont.start(wait=True)
\ No newline at end of file
+    try:
+        state = cont.api.state.get().json()['metadata']["status_code"]
+        was_running = False
+        if int(state) != 102:
+            if int(state) == 103:
+                was_running = True
+            cont.stop(wait=True)
+        cont.migrate(client_destination, wait=True)
+
+        if was_running:
+            cont = client_destination.containers.get(co.name)
+            cont.start(wait=True)
+    finally:
+        sync_soon(srchost.id, co.host_id)
\ No newline at end of file
@@ -1,3 +1,547 @@
-# from django.test import TestCase
+import json
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Permission, User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from pylxd.exceptions import LXDAPIException, NotFound
+from rest_framework.test import APIClient
+
+from apps.host.locks import Lease, LeaseLost, LocalLocks
+from apps.host.lxd import _PooledNode
+from apps.host.models import Host, Image, Subnet
+from apps.host.tasks import sync_images
+
+from . import changes
+from .models import IP, Container, ContainerChange, Project
+from .tasks import DELETED_STATE, apply_states, collect_states_bulk, refresh_container, synchost, synclxd
+
+
+class ContainerFixture(object):
+
+    def setUp(self):
+        subnet = Subnet.objects.create(ip="192.0.2.0", prefixlen=24)
+        self.host = Host.objects.create(name="host", subnet=subnet, api_url="https://127.0.0.1:8443")
+        self.project = Project.objects.create(name="project")
+        self.count = 0
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser("admin", "admin@example.com", "pw"))
+
+    def add_containers(self, n):
+        for i in range(n):
+            self.count += 1
+            ct = Container.objects.create(name="ct%d" % self.count, host=self.host, project=self.project,
+                                          state='{"status_code": 103}', config="{}")
+            IP.objects.create(ip="192.0.2.%d" % self.count, prefixlen=24, container=ct)
+            v6 = IP.objects.create(ip="2001:db8::%x" % self.count, prefixlen=64, container=ct, container_target=ct)
+            IP.objects.create(ip="198.51.100.%d" % self.count, prefixlen=24, siit_map=v6)
+
+
+class ContainerListQueriesTest(ContainerFixture, TestCase):
+
+    def list_queries(self, client):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get("/api/container/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), self.count)
+        for ct in response.json():
+            self.assertEqual(len(ct["ips"]), 2)
+        return len(queries)
+
+    def assert_constant_queries(self, client):
+        self.add_containers(2)
+        # the forced user caches its permissions on the first request
+        self.list_queries(client)
+        few = self.list_queries(client)
+        self.add_containers(20)
+        self.assertEqual(self.list_queries(client), few)
+
+    def test_superuser(self):
+        self.assert_constant_queries(self.client)
+
+    def test_project_member(self):
+        user = User.objects.create_user("member")
+        user.user_permissions.add(Permission.objects.get(codename="view_container"))
+        self.project.users.add(user)
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assert_constant_queries(client)
+
+
+class ContainerListPaginationTest(ContainerFixture, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_containers(5)
+
+    def test_unpaginated_by_default(self):
+        self.assertEqual(len(self.client.get("/api/container/").json()), 5)
+
+    def test_cursor_pages(self):
+        page = self.client.get("/api/container/", {"page_size": 2}).json()
+        names = [ct["name"] for ct in page["results"]]
+        while page["next"]:
+            page = self.client.get(page["next"]).json()
+            names += [ct["name"] for ct in page["results"]]
+        self.assertEqual(names, ["ct%d" % i for i in range(1, 6)])
+
+    def test_sparse_fields(self):
+        for ct in self.client.get("/api/container/", {"fields": "id,name"}).json():
+            self.assertEqual(set(ct), {"id", "name"})
+
+
+class ContainerConditionalGetTest(ContainerFixture, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_containers(2)
+
+    def test_not_modified(self):
+        response = self.client.get("/api/container/")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        response = self.client.get("/api/container/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ct = Container.objects.get(name="ct1")
+            ct.target_status_code = 102
+            ct.save()
+        response = self.client.get("/api/container/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_modified_since_ignored(self):
+        modified = self.client.get("/api/container/")["Last-Modified"]
+        self.assertEqual(self.client.get("/api/container/", HTTP_IF_MODIFIED_SINCE=modified).status_code, 200)
+
+    def test_detail_checks_object(self):
+        user = User.objects.create_user("member")
+        user.user_permissions.add(Permission.objects.get(codename="view_container"))
+        self.project.users.add(user)
+        client = APIClient()
+        client.force_authenticate(user)
+        ct1, ct2 = Container.objects.get(name="ct1"), Container.objects.get(name="ct2")
+        etags = dict((ct.pk, client.get("/api/container/%d/" % ct.pk)["ETag"]) for ct in (ct1, ct2))
+
+        # neither change is committed, the counter and the ETags stay the same
+        ct1.delete()
+        self.assertEqual(client.get("/api/container/%d/" % ct1.pk, HTTP_IF_NONE_MATCH=etags[ct1.pk]).status_code,
+                         404)
+        self.project.users.remove(user)
+        self.assertEqual(client.get("/api/container/%d/" % ct2.pk, HTTP_IF_NONE_MATCH=etags[ct2.pk]).status_code,
+                         404)
+
+    def test_etag_per_path(self):
+        etag = self.client.get("/api/container/").get("ETag")
+        self.assertEqual(self.client.get("/api/container/", {"fields": "name"}, HTTP_IF_NONE_MATCH=etag).status_code,
+                         200)
+
+    def test_image_list_host_memory(self):
+        etag = self.client.get("/api/image/").get("ETag")
+        with self.captureOnCommitCallbacks(execute=True):
+            ct = Container.objects.get(name="ct1")
+            ct.state = '{"status_code": 103, "memory": {"usage": 1024}}'
+            ct.save()
+        self.assertEqual(self.client.get("/api/image/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class ContainerEventsTest(ContainerFixture, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_containers(2)
+
+    def events(self, client, **params):
+        response = client.get("/api/container/events/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_changes(self):
+        last = self.events(self.client)["last"]
+        self.assertEqual(self.events(self.client, after=last)["events"], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ct = Container.objects.get(name="ct1")
+            ct.target_status_code = 102
+            ct.save()
+        page = self.events(self.client, after=last)
+        self.assertEqual([(e["name"], e["target_status_code"]) for e in page["events"]], [("ct1", 102)])
+        self.assertEqual(page["events"][0]["ips"], ["192.0.2.1", "2001:db8::1"])
+        self.assertEqual(self.events(self.client, after=page["last"])["events"], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ct.delete()
+        self.assertEqual([e["action"] for e in self.events(self.client, after=page["last"])["events"]], ["delete"])
+
+    def stream(self):
+        response = self.client.get("/api/container/events/", {"after": 0}, HTTP_ACCEPT="text/event-stream")
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    @override_settings(CONTAINER_EVENTS_STREAM=0, CONTAINER_EVENTS_STREAMS=1)
+    def test_stream_ends_and_frees_its_slot(self):
+        # a second stream only gets the slot if the first one gave it back
+        for i in range(2):
+            self.assertTrue(self.stream().startswith("retry: %d\n" % changes.RETRY))
+        self.assertEqual(changes._streams, 0)
+
+    @override_settings(CONTAINER_EVENTS_STREAMS=0)
+    def test_busy_streams_poll(self):
+        body = self.stream()
+        self.assertTrue(body.startswith("retry: %d\n" % changes.BUSY_RETRY))
+        self.assertEqual(body.count("event: container"), ContainerChange.objects.count())
+
+    def test_project_members_only(self):
+        user = User.objects.create_user("member")
+        user.user_permissions.add(Permission.objects.get(codename="view_container"))
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assertEqual(self.events(client, after=0)["events"], [])
+
+        self.project.users.add(user)
+        self.assertEqual({e["name"] for e in self.events(client, after=0)["events"]}, {"ct1", "ct2"})
+
+
+class HostStatsTest(ContainerFixture, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_containers(3)
+        ct = Container.objects.get(name="ct1")
+        ct.state = '{"status_code": 102, "memory": {"usage": 0}}'
+        ct.save()
+        Container.objects.filter(name__in=["ct2", "ct3"]).update(memory_usage=1024)
+
+    def test_host_list(self):
+        Host.objects.create(name="empty", subnet=self.host.subnet)
+        with CaptureQueriesContext(connection) as queries:
+            hosts = self.client.get("/api/host/").json()
+        few = len(queries)
+        stats = dict((h["name"], (h["used_memory"], h["container_states"])) for h in hosts)
+        self.assertEqual(stats, {"host": (2048, {"102": 1, "103": 2}), "empty": (0, {})})
+
+        for i in range(5):
+            Host.objects.create(name="host%d" % i, subnet=self.host.subnet)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/api/host/")
+        self.assertEqual(len(queries), few)
+
+    def test_host_detail(self):
+        host = self.client.get("/api/host/%d/" % self.host.pk).json()
+        self.assertEqual((host["used_memory"], host["container_states"]), (2048, {"102": 1, "103": 2}))
+
+
+class PooledNodeTest(SimpleTestCase):
+
+    def test_children_share_the_session(self):
+        api = _PooledNode("http://127.0.0.1:8443/1.0")
+        self.assertIs(api.containers["ct1"].state.session, api.session)
+        self.assertIs(api.images.session, api.session)
+
+
+def image_client(*fingerprints):
+    client = mock.MagicMock()
+    client.api.images.get.return_value.json.return_value = {"metadata": [
+        {"fingerprint": fingerprint, "properties": {}, "aliases": [{"name": "alias-%s" % fingerprint}]}
+        for fingerprint in fingerprints]}
+    return client
+
+
+def writes(queries):
+    return [q["sql"] for q in queries.captured_queries if q["sql"].split()[0] in ("INSERT", "UPDATE", "DELETE")]
+
+
+@mock.patch("apps.host.tasks.pull_image.delay")
+class SyncImagesTest(ContainerFixture, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("apps.host.tasks.backend", return_value=LocalLocks())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def available(self, host):
+        return dict(Image.available.through.objects.filter(host=host).values_list("image__fingerprint", "pk"))
+
+    def test_unchanged_no_writes(self, delay):
+        sync_images(image_client("a", "b"), self.host)
+        with CaptureQueriesContext(connection) as queries:
+            sync_images(image_client("a", "b"), self.host)
+        self.assertEqual(writes(queries), [])
+        self.assertEqual(set(self.available(self.host)), {"a", "b"})
+
+    def test_added_and_removed(self, delay):
+        sync_images(image_client("a", "b"), self.host)
+        before = self.available(self.host)
+        sync_images(image_client("a", "c"), self.host)
+        after = self.available(self.host)
+        self.assertEqual(set(after), {"a", "c"})
+        # the row of the image the host kept stays
+        self.assertEqual(after["a"], before["a"])
+        self.assertTrue(Image.objects.filter(fingerprint="b").exists())
+
+    def test_one_pull_per_host(self, delay):
+        image = Image.objects.create(fingerprint="j", properties="{}", sync=True, alias="jammy")
+        other = Host.objects.create(name="other", subnet=self.host.subnet)
+        for host in (self.host, self.host, other):
+            sync_images(image_client("a"), host)
+        # the second sync of the host does not queue the pull still in flight
+        self.assertEqual(sorted(c.args[:2] for c in delay.call_args_list),
+                         sorted([(image.pk, self.host.pk), (image.pk, other.pk)]))
+
+
+def lxd_state(status_code=103, ips=(), memory=1000):
+    addresses = [{"address": ip, "netmask": "64" if ":" in ip else "24"} for ip in ips]
+    return {"status": "Running" if status_code == 103 else "Stopped", "status_code": status_code,
+            "memory": {"usage": memory}, "cpu": {"usage": 5}, "disk": {}, "processes": 10,
+            "network": {"eth0": {"state": "up", "addresses": addresses, "counters": {"bytes_received": memory}}}}
+
+
+CONFIG = {"security.nesting": "true", "user.vendor-data": "private host keys"}
+
+
+@mock.patch("apps.container.tasks.publish")
+class ApplyStatesTest(ContainerFixture, TestCase):
+
+    def apply(self, states, complete=True, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return apply_states(self.host, states, complete=complete, **kwargs)
+
+    def create(self):
+        self.apply([("web", lxd_state(ips=["45.0.0.5", "2a01:4f8::5"]), CONFIG)])
+        return Container.objects.get(name="web")
+
+    def changes(self, ct):
+        return ContainerChange.objects.filter(container_pk=ct.pk).count()
+
+    def test_cold_create(self, publish):
+        self.assertTrue(self.apply([("web", lxd_state(ips=["45.0.0.5", "2a01:4f8::5"]), CONFIG)]))
+        ct = Container.objects.get(name="web")
+        self.assertEqual(json.loads(ct.config)["user.vendor-data"], "****")
+        self.assertEqual((ct.status_code, ct.memory_usage, ct.cpu_usage, ct.processes), (103, 1000, 5, 10))
+        self.assertIsNotNone(ct.state_digest)
+
+        self.assertEqual(IP.objects.get(ip="45.0.0.5").container, ct)
+        self.assertIsNone(IP.objects.get(ip="45.0.0.5").container_target)
+        self.assertEqual(IP.objects.get(ip="2a01:4f8::5").container_target, ct)
+
+        self.assertEqual(self.changes(ct), 1)
+        publish.assert_called_once_with("host", self.host.pk, "sync")
+
+    def test_warm_noop(self, publish):
+        ct = self.create()
+        publish.reset_mock()
+
+        self.assertFalse(self.apply([("web", lxd_state(ips=["45.0.0.5", "2a01:4f8::5"]), CONFIG)]))
+        self.assertEqual(Container.objects.get(pk=ct.pk).state_version, ct.state_version)
+        self.assertEqual(self.changes(ct), 1)
+        publish.assert_not_called()
+
+    def test_counters_only(self, publish):
+        ct = self.create()
+        publish.reset_mock()
+
+        # within LXD_COUNTERS_INTERVAL nothing is written
+        self.assertFalse(self.apply([("web", lxd_state(ips=["45.0.0.5", "2a01:4f8::5"], memory=2000), CONFIG)]))
+        self.assertEqual(Container.objects.get(pk=ct.pk).memory_usage, 1000)
+
+        with override_settings(LXD_COUNTERS_INTERVAL=0):
+            self.assertFalse(self.apply([("web", lxd_state(ips=["45.0.0.5", "2a01:4f8::5"], memory=3000), CONFIG)]))
+        updated = Container.objects.get(pk=ct.pk)
+        self.assertEqual(updated.memory_usage, 3000)
+        self.assertEqual(json.loads(updated.state)["memory"]["usage"], 3000)
+        self.assertEqual((updated.state_version, updated.state_digest), (ct.state_version, ct.state_digest))
+        self.assertEqual(self.changes(ct), 1)
+        publish.assert_not_called()
+
+    def test_target_reached(self, publish):
+        ct = self.create()
+        Container.objects.filter(pk=ct.pk).update(target_status_code=102)
+
+        # still running, the target stays pending
+        self.assertFalse(self.apply([("web", lxd_state(ips=["45.0.0.5", "2a01:4f8::5"]), CONFIG)]))
+        self.assertEqual(Container.objects.get(pk=ct.pk).target_status_code, 102)
+
+        self.assertTrue(self.apply([("web", lxd_state(102), CONFIG)]))
+        stopped = Container.objects.get(pk=ct.pk)
+        self.assertIsNone(stopped.target_status_code)
+        self.assertEqual(stopped.status_code, 102)
+        self.assertEqual(self.changes(ct), 2)
+
+    def test_missing_deleted(self, publish):
+        ct = self.create()
+        creating = Container.objects.create(name="new", host=self.host, state='{"status_code": 114}', config="{}")
+
+        self.assertTrue(self.apply([]))
+        deleted = Container.objects.get(pk=ct.pk)
+        self.assertEqual((deleted.state, deleted.status_code), (DELETED_STATE, 113))
+        self.assertEqual(Container.objects.get(pk=creating.pk).status_code, 114)
+
+        # removed once it stayed deleted for 10 minutes
+        Container.objects.filter(pk=ct.pk).update(state_version=datetime.now(timezone.utc) - timedelta(minutes=11))
+        self.assertTrue(self.apply([]))
+        self.assertFalse(Container.objects.filter(pk=ct.pk).exists())
+        self.assertEqual(ContainerChange.objects.filter(container_pk=ct.pk, action=ContainerChange.DELETE).count(), 1)
+
+    def test_partial_keeps_missing(self, publish):
+        ct = self.create()
+        self.assertFalse(self.apply([], complete=False))
+        self.assertEqual(Container.objects.get(pk=ct.pk).status_code, 103)
+
+    def test_fenced(self, publish):
+        Host.objects.filter(pk=self.host.pk).update(sync_token=10)
+        with self.assertRaises(LeaseLost):
+            self.apply([("web", lxd_state(), CONFIG)], token=9)
+        self.assertFalse(Container.objects.filter(name="web").exists())
+        self.apply([("web", lxd_state(), CONFIG)], token=11)
+        self.assertEqual(Host.objects.get(pk=self.host.pk).sync_token, 11)
+
+
+class CollectStatesBulkTest(SimpleTestCase):
+
+    def collect(self, metadata):
+        client = mock.MagicMock()
+        client.api.containers.get.return_value.json.return_value = {"metadata": metadata}
+        return collect_states_bulk(client)
+
+    def test_listing(self):
+        states = self.collect([{"name": "ct1", "state": lxd_state(), "expanded_config": CONFIG}])
+        self.assertEqual(list(states), [("ct1", lxd_state(), CONFIG)])
+
+    def test_old_servers(self):
+        self.assertIsNone(self.collect(["/1.0/containers/ct1"]))
+        self.assertIsNone(self.collect([{"name": "ct1", "state": None, "expanded_config": {}}]))
+
+    def test_error(self):
+        client = mock.MagicMock()
+        client.api.containers.get.side_effect = LXDAPIException(mock.Mock())
+        self.assertIsNone(collect_states_bulk(client))
+
+
+@mock.patch("apps.container.tasks.publish")
+class RefreshContainerTest(ContainerFixture, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.locks = LocalLocks()
+        patcher = mock.patch("apps.host.locks.backend", return_value=self.locks)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refresh(self, name, state=None):
+        ct = mock.Mock()
+        ct.name = name
+        ct.api.state.get.return_value.json.return_value = {"metadata": state}
+        ct.expanded_config = {}
+        client = mock.Mock()
+        if state is None:
+            client.containers.get.side_effect = NotFound(mock.Mock())
+        else:
+            client.containers.get.return_value = ct
+        with self.captureOnCommitCallbacks(execute=True):
+            refresh_container(client, self.host, name)
+        return client
+
+    def test_new_container(self, publish):
+        self.refresh("new", lxd_state(ips=["2a01:4f8::7"]))
+        ct = Container.objects.get(name="new")
+        self.assertEqual(ct.status_code, 103)
+        self.assertEqual([ip.ip for ip in ct.ip_set.all()], ["2a01:4f8::7"])
+        self.assertGreater(Host.objects.get(pk=self.host.pk).sync_token, 0)
+
+    def test_gone(self, publish):
+        self.add_containers(1)
+        self.refresh("ct1")
+        self.assertEqual(Container.objects.get(name="ct1").state, DELETED_STATE)
+
+    def test_later_writer_wins(self, publish):
+        # a sync with a later token wrote already, the refresh fetched before it
+        Host.objects.filter(pk=self.host.pk).update(sync_token=2 ** 62)
+        self.refresh("new", lxd_state())
+        self.assertFalse(Container.objects.filter(name="new").exists())
+
+    @override_settings(LXD_SYNC_LEASE=1)
+    def test_waits_for_sync(self, publish):
+        self.locks.acquire("sync:%s" % self.host.pk, 60)
+        client = self.refresh("new", lxd_state())
+        client.containers.get.assert_not_called()
+        self.assertFalse(Container.objects.filter(name="new").exists())
+
+
+@mock.patch("apps.container.tasks.synchost.apply_async")
+class SyncSchedulerTest(ContainerFixture, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.locks = LocalLocks()
+        patcher = mock.patch("apps.container.tasks.backend", return_value=self.locks)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ago = datetime.now(timezone.utc) - timedelta(minutes=5)
+
+    def test_queued_not_again(self, apply_async):
+        # waits in the queue, below LXD_SYNC_QUEUE_TIMEOUT
+        Host.objects.filter(pk=self.host.pk).update(next_sync=self.ago, sync_queued=self.ago)
+        synclxd()
+        apply_async.assert_not_called()
+
+    def test_died_sync_queued_again(self, apply_async):
+        Host.objects.filter(pk=self.host.pk).update(next_sync=self.ago, sync_queued=self.ago, sync_started=self.ago)
+        token = self.locks.acquire("sync:%s" % self.host.pk, 60)
+        synclxd()
+        apply_async.assert_not_called()
+
+        # the lease of the dead worker ran out
+        self.locks.release("sync:%s" % self.host.pk, token)
+        synclxd()
+        apply_async.assert_called_once()
+        host = Host.objects.get(pk=self.host.pk)
+        self.assertGreater(host.sync_queued, self.ago)
+        self.assertIsNone(host.sync_started)
+
+    def test_long_sync_not_again(self, apply_async):
+        # queued and started long ago, but its worker still renews the lease
+        long_ago = datetime.now(timezone.utc) - timedelta(minutes=20)
+        Host.objects.filter(pk=self.host.pk).update(next_sync=long_ago, sync_queued=long_ago,
+                                                    sync_started=long_ago)
+        self.locks.acquire("sync:%s" % self.host.pk, 60)
+        synclxd()
+        apply_async.assert_not_called()
+        self.assertEqual(Host.objects.get(pk=self.host.pk).sync_started, long_ago)
+
+    def test_never_started_again(self, apply_async):
+        long_ago = datetime.now(timezone.utc) - timedelta(minutes=20)
+        Host.objects.filter(pk=self.host.pk).update(next_sync=long_ago, sync_queued=long_ago)
+        synclxd()
+        apply_async.assert_called_once()
+
+    def test_interval_from_claim(self, apply_async):
+        # a 30s interval is a 30s cadence on the 30s beat, although the sync ends after the claim
+        with mock.patch("apps.container.tasks.datetime") as clock, \
+                mock.patch("apps.container.tasks.get_client", side_effect=LXDAPIException(mock.Mock())), \
+                mock.patch("apps.host.locks.backend", return_value=self.locks):
+            clock.now.return_value = self.ago
+            synclxd()
+            clock.now.return_value = self.ago + timedelta(seconds=10)
+            synchost(self.host.pk)
+            clock.now.return_value = self.ago + timedelta(seconds=30)
+            synclxd()
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(Host.objects.get(pk=self.host.pk).sync_queued, self.ago + timedelta(seconds=30))
+
+    def test_lost_lease(self, apply_async):
+        with mock.patch("apps.host.locks.backend", return_value=self.locks):
+            lease = Lease("sync:%s" % self.host.pk, 60)
+            self.assertTrue(lease.acquire())
+            lease.check()
+            lease.lost = True
+            self.assertFalse(lease.valid())
+            self.assertRaises(LeaseLost, lease.check)
+            lease.release()
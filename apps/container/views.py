@@ -2,17 +2,21 @@ from django.db.models import Q
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
-from django.http.response import HttpResponse
+from django.conf import settings
+from django.http.response import HttpResponse, StreamingHttpResponse
 
-from apps.account.drf import IsStaff, IsSuperuser, is_sudo
+from apps.account.drf import ConditionalMixin, EventStreamRenderer, IsStaff, IsSuperuser, is_sudo
 
-from .models import IP, Container, Hostkey
+from .changes import last_change, stream_changes, wait_changes
+from .models import IP, Container, ContainerChange, Hostkey, Project
 from .serializers import ContainerCreateSerializer, ContainerSerializer, ContainerFatSerializer, ContainerKeySerializer, IPAdminSerializer, IPSerializer
 from .tasks import container_action, container_reconfig_ip, container_reconfig_keys, delete_container, container_migrate
 
 
-class IPViewSet(viewsets.ModelViewSet):
+class IPViewSet(ConditionalMixin, viewsets.ModelViewSet):
+    change_scope = 'ip'
     serializer_class = IPSerializer
 
     def get_queryset(self):
@@ -58,7 +62,8 @@ class IPViewSet(viewsets.ModelViewSet):
             container_reconfig_ip.delay(serializer.instance.container_target.id)
 
 
-class ContainerViewSet(viewsets.ModelViewSet):
+class ContainerViewSet(ConditionalMixin, viewsets.ModelViewSet):
+    change_scope = 'container'
     serializer_class = ContainerSerializer
 
     def get_queryset(self):
@@ -66,6 +71,9 @@ class ContainerViewSet(viewsets.ModelViewSet):
             queryset = Container.objects.all()
         else:
             queryset = Container.objects.filter(project__users=self.request.user)
+        if self.action == 'list':
+            # everything ContainerFatSerializer touches, see Container.get_all_ips
+            queryset = queryset.select_related("project", "host").prefetch_related("ip_set", "target_ip")
         return queryset
 
     def get_serializer_class(self):
@@ -88,6 +96,36 @@ class ContainerViewSet(viewsets.ModelViewSet):
         permission_classes = [IsStaff]
         return [permission() for permission in permission_classes]
 
+    @action(detail=False, methods=['get'], renderer_classes=api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer])
+    def events(self, request):
+        """
+        state, target status and address changes of the visible containers after
+        ?after= or the Last-Event-ID header (from now on without either). Streams
+        them to text/event-stream clients, otherwise answers with the next changes
+        as soon as there are some or after ?wait= seconds.
+        """
+        changes = ContainerChange.objects.all()
+        if not is_sudo(request):
+            changes = changes.filter(project_pk__in=Project.objects.filter(users=request.user).values("pk"))
+
+        try:
+            after = int(request.query_params.get('after', request.META.get('HTTP_LAST_EVENT_ID')))
+        except (TypeError, ValueError):
+            after = last_change()
+
+        if request.accepted_renderer.format == EventStreamRenderer.format:
+            response = StreamingHttpResponse(stream_changes(changes, after), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        try:
+            wait = min(float(request.query_params.get('wait', 0)), getattr(settings, "CONTAINER_EVENTS_WAIT"))
+        except ValueError:
+            wait = 0
+        found = wait_changes(changes, after, wait)
+        return Response({"last": found[-1].id if found else after, "events": [c.as_event() for c in found]})
+
     @action(detail=True, methods=['get'])
     def vendor_network(self, request, pk=None):
         return HttpResponse(self.get_object().get_network_config(vendor=True)["user.network-config"])
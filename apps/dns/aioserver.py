@@ -0,0 +1,93 @@
+import asyncio
+import struct
+
+from dnslib import RCODE
+from dnslib.dns import DNSRecord, DNSError
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        task = asyncio.ensure_future(self.server.handle_udp(self.transport, data, addr))
+        # the loop only keeps weak references to tasks
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+class AsyncDNSServer(object):
+    """
+    asyncio UDP (and optionally TCP) server, the resolver has to provide
+    `async resolve_async(request)` returning the reply record and
+    `cached_reply(data)` returning a packed reply to a raw query or None.
+    """
+
+    def __init__(self, resolver, address="", port=53, tcp=False, udplen=0, reuse_port=False):
+        self.resolver = resolver
+        self.reuse_port = reuse_port
+        self.address = address or None
+        self.port = port
+        self.tcp = tcp
+        self.udplen = udplen
+
+    async def get_reply(self, data, udp):
+        packet = self.resolver.cached_reply(data)
+        if packet is not None and not (udp and self.udplen and len(packet) > self.udplen):
+            return packet
+        try:
+            request = DNSRecord.parse(data)
+        except DNSError as e:
+            print("invalid request:", e)
+            return None
+        try:
+            reply = await self.resolver.resolve_async(request)
+        except Exception as e:
+            print("resolving %s failed:" % request.q.qname, repr(e))
+            reply = request.reply()
+            reply.header.rcode = RCODE.SERVFAIL
+        packet = reply.pack()
+        if udp and self.udplen and len(packet) > self.udplen:
+            reply.truncate()
+            packet = reply.pack()
+        return packet
+
+    async def handle_udp(self, transport, data, addr):
+        packet = await self.get_reply(data, udp=True)
+        if packet is not None:
+            transport.sendto(packet, addr)
+
+    async def handle_tcp(self, reader, writer):
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                packet = await self.get_reply(await reader.readexactly(length), udp=False)
+                if packet is None:
+                    break
+                writer.write(struct.pack("!H", len(packet)) + packet)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: _UDPProtocol(self), local_addr=(self.address or "0.0.0.0", self.port),
+                                            reuse_port=self.reuse_port or None)
+        if self.tcp:
+            await asyncio.start_server(self.handle_tcp, self.address, self.port, reuse_port=self.reuse_port or None)
+
+    def serve_forever(self, ready=None):
+        async def run():
+            await self.start()
+            if ready is not None:
+                ready()
+            await asyncio.Event().wait()
+        asyncio.run(run())
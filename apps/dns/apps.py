@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class DNSConfig(AppConfig):
     name = 'apps.dns'
+
+    def ready(self):
+        from . import signals  # noqa: F401
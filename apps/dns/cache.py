@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+from dnslib import QTYPE, RCODE
+from dnslib.dns import DNSRecord
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of upstream replies keyed by (qname, qtype, qclass).
+
+    Answers are kept for their smallest TTL, NXDOMAIN/NODATA replies for
+    min(SOA ttl, SOA minimum) as in RFC 2308; replies without SOA or with other
+    rcodes are not cached. Handed out replies carry the remaining TTLs.
+    """
+
+    def __init__(self, size=10000, max_ttl=3600):
+        self.size = size
+        self.max_ttl = max_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(request):
+        return str(request.q.qname).lower(), request.q.qtype, request.q.qclass
+
+    def ttl(self, reply):
+        if reply.header.rcode not in (RCODE.NOERROR, RCODE.NXDOMAIN) or reply.header.tc:
+            return 0
+        if reply.header.rcode == RCODE.NOERROR and len(reply.rr):
+            ttl = min(rr.ttl for rr in reply.rr)
+        else:
+            soas = [rr for rr in reply.auth if rr.rtype == QTYPE.SOA]
+            if not soas:
+                return 0
+            ttl = min(soas[0].ttl, soas[0].rdata.times[-1])
+        return min(ttl, self.max_ttl)
+
+    def get(self, request):
+        key = self.key(request)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        expires, stored, packet = entry
+        reply = DNSRecord.parse(packet)
+        reply.header.id = request.header.id
+        reply.questions = list(request.questions)
+        age = int(now - stored)
+        for rr in reply.rr + reply.auth + reply.ar:
+            if rr.rtype != QTYPE.OPT:
+                rr.ttl = max(rr.ttl - age, 0)
+        return reply
+
+    def put(self, request, reply):
+        ttl = self.ttl(reply)
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        packet = reply.pack()
+        key = self.key(request)
+        with self._lock:
+            self._entries[key] = (now + ttl, now, packet)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,126 @@
+import asyncio
+import secrets
+import struct
+
+from dnslib.dns import DNSRecord, DNSError
+
+from .wire import read_question
+
+
+def parse_server(server):
+    """
+    "host", "host:port" or "[v6]:port" to (host, port)
+    """
+    if server.startswith("["):
+        host, _, port = server[1:].partition("]:")
+        return host, int(port or 53)
+    if server.count(":") == 1:
+        host, port = server.split(":")
+        return host, int(port)
+    return server, 53
+
+
+def answers(query, data):
+    """
+    whether the raw reply data has the id and the question of the raw query
+    """
+    question = read_question(query)
+    reply = read_question(data)
+    return data[:2] == query[:2] and question is not None and reply is not None and reply[0] == question[0]
+
+
+class Forwarder(object):
+    """
+    Blocking forwarder for the threaded server, tries the upstreams in order.
+    Replies have to carry the id and the question of the query.
+    """
+
+    def __init__(self, servers, timeout):
+        self.servers = [parse_server(s) for s in servers]
+        self.timeout = timeout
+
+    def forward(self, request):
+        # a random id of our own, a fresh socket (source port) is used for every send
+        query = DNSRecord.parse(struct.pack("!H", secrets.randbelow(65536)) + request.pack()[2:])
+        packet = query.pack()
+        for host, port in self.servers:
+            try:
+                ipv6 = ":" in host
+                data = query.send(host, port, timeout=self.timeout, ipv6=ipv6)
+                if answers(packet, data) and DNSRecord.parse(data).header.tc:
+                    data = query.send(host, port, tcp=True, timeout=self.timeout, ipv6=ipv6)
+                if not answers(packet, data):
+                    raise DNSError("reply does not match the query")
+                reply = DNSRecord.parse(data)
+                reply.header.id = request.header.id
+                return reply
+            except (OSError, DNSError) as e:
+                print("upstream %s:%d failed:" % (host, port), e)
+        return None
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    a single query, resolves future with the first reply which answers it
+    """
+
+    def __init__(self, query, future):
+        self.query = query
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done() and answers(self.query, data):
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        print("upstream error:", exc)
+
+
+class AsyncForwarder(object):
+    """
+    Non-blocking forwarder. Every query goes out with a random id from its own
+    connected UDP socket, i.e. a random source port, and only a reply with that
+    id and the same question is accepted.
+    On timeout the next upstream is asked, truncated replies are retried over TCP.
+    """
+
+    def __init__(self, servers, timeout):
+        self.servers = [parse_server(s) for s in servers]
+        self.timeout = timeout
+
+    async def _query_udp(self, server, packet):
+        loop = asyncio.get_running_loop()
+        query = struct.pack("!H", secrets.randbelow(65536)) + packet[2:]
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _UpstreamProtocol(query, future),
+                                                           remote_addr=server)
+        try:
+            transport.sendto(query)
+            data = await asyncio.wait_for(future, self.timeout)
+        finally:
+            transport.close()
+        return packet[:2] + data[2:]
+
+    async def _query_tcp(self, server, packet):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*server), self.timeout)
+        try:
+            writer.write(struct.pack("!H", len(packet)) + packet)
+            length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+            data = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+            if not answers(packet, data):
+                raise DNSError("reply does not match the query")
+            return data
+        finally:
+            writer.close()
+
+    async def forward(self, request):
+        packet = request.pack()
+        for server in self.servers:
+            try:
+                reply = DNSRecord.parse(await self._query_udp(server, packet))
+                if reply.header.tc:
+                    reply = DNSRecord.parse(await self._query_tcp(server, packet))
+                return reply
+            except (asyncio.TimeoutError, OSError, DNSError, asyncio.IncompleteReadError) as e:
+                print("upstream %s:%d failed:" % server, repr(e))
+        return None
@@ -0,0 +1,96 @@
+import select
+import socket
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# notifications are "<model>:<pk>:<action>", "*" as model asks for a full reload
+RESYNC = ("*", None, "resync")
+
+
+def _address():
+    host, port = settings.DNS_NOTIFY_ADDRESS.rsplit(":", 1)
+    return host, int(port)
+
+
+def _send_datagram(payload):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(payload.encode(), _address())
+    except OSError as e:
+        print("dns notify failed:", e)
+
+
+def parse(payload):
+    try:
+        model, pk, action = payload.split(":")
+        return model, int(pk), action
+    except ValueError:
+        return RESYNC
+
+
+def _notify_postgres(payload):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [settings.DNS_NOTIFY_CHANNEL, payload])
+    except Exception as e:
+        print("dns notify failed:", e)
+
+
+def publish(model, pk, action="save"):
+    """
+    tell the DNS server that a row changed, once the current transaction commits.
+
+    On PostgreSQL this is a NOTIFY in its own autocommitted statement, so a failure
+    cannot abort the transaction of the caller. Otherwise (SQLite) a datagram is
+    sent to DNS_NOTIFY_ADDRESS.
+    """
+    payload = "%s:%s:%s" % (model, pk, action)
+    if connection.vendor == 'postgresql':
+        transaction.on_commit(lambda: _notify_postgres(payload))
+    else:
+        transaction.on_commit(lambda: _send_datagram(payload))
+
+
+def _listen_postgres(callback):
+    conn = connection.get_new_connection(connection.get_connection_params())
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('LISTEN "%s"' % settings.DNS_NOTIFY_CHANNEL)
+        # anything could have changed while we were not listening
+        callback(*RESYNC)
+        while True:
+            if select.select([conn], [], [], 5) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                callback(*parse(conn.notifies.pop(0).payload))
+    finally:
+        conn.close()
+
+
+def _listen_socket(callback):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(_address())
+        callback(*RESYNC)
+        while True:
+            data, _ = s.recvfrom(512)
+            callback(*parse(data.decode(errors="replace")))
+
+
+def listen(callback):
+    """
+    blocks forever and calls callback(model, pk, action) for every change,
+    reconnects on errors. Run it in a thread.
+    """
+    while True:
+        try:
+            if connection.vendor == 'postgresql':
+                _listen_postgres(callback)
+            else:
+                _listen_socket(callback)
+        except Exception as e:
+            print("dns notify listener failed, reconnecting:", e)
+            time.sleep(1)
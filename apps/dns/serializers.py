@@ -2,17 +2,19 @@ import json
 
 from rest_framework import serializers
 
+from apps.account.drf import SparseFieldsMixin
+
 from .models import ZoneExtra, DynamicEntry
 
 
-class ZoneSerializer(serializers.ModelSerializer):
+class ZoneSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = ZoneExtra
         fields = ('entry', 'url', 'description')
 
 
-class DynamicSerializer(serializers.ModelSerializer):
+class DynamicSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = DynamicEntry
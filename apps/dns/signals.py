@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import DynamicEntry, ZoneExtra
+from .notify import publish
+
+
+@receiver(post_save, sender=ZoneExtra)
+@receiver(post_save, sender=DynamicEntry)
+def entry_saved(sender, instance, **kwargs):
+    publish(sender._meta.model_name, instance.pk, "save")
+
+
+@receiver(post_delete, sender=ZoneExtra)
+@receiver(post_delete, sender=DynamicEntry)
+def entry_deleted(sender, instance, **kwargs):
+    publish(sender._meta.model_name, instance.pk, "delete")
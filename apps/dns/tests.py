@@ -0,0 +1,276 @@
+import asyncio
+from fnmatch import fnmatch
+from unittest import mock
+
+from dnslib import QTYPE, RCODE, RR, A
+from dnslib.dns import DNSRecord
+from dnslib.label import DNSLabel
+from django.test import SimpleTestCase, TestCase
+
+from .aioserver import AsyncDNSServer
+from .cache import ResponseCache
+from .models import ZoneExtra
+from .wire import AnswerTemplates, parse_question, read_question
+from .zone import ContainerIndex, GlobTrie, ZoneIndex, name_key, split_glob
+
+
+def answered(name="example.org", ttl=60):
+    request = DNSRecord.question(name, "A")
+    reply = request.reply()
+    reply.add_answer(RR(name, QTYPE.A, rdata=A("192.0.2.1"), ttl=ttl))
+    return request, reply
+
+
+def negative(name="missing.example.org", rcode=RCODE.NXDOMAIN, soa=True):
+    request = DNSRecord.question(name, "A")
+    reply = request.reply()
+    reply.header.rcode = rcode
+    if soa:
+        reply.add_auth(*RR.fromZone("example.org. 300 IN SOA ns.example.org. admin.example.org. 1 900 900 1800 60"))
+    return request, reply
+
+
+class ZoneIndexTest(TestCase):
+
+    def setUp(self):
+        self.entries = {}
+        for entry in ["www 60 IN A 192.0.2.1",
+                      "Mixed 60 IN A 192.0.2.2",
+                      "* 60 IN A 192.0.2.9",
+                      "*.web 60 IN A 192.0.2.10",
+                      "alias 60 IN CNAME www.lxd.example.",
+                      "db-* 60 IN AAAA 2001:db8::1"]:
+            self.entries[entry.split()[0]] = ZoneExtra.objects.create(entry=entry)
+        self.index = ZoneIndex("lxd.example.")
+        self.index.rebuild()
+
+    def lookup(self, name, qtype=QTYPE.A):
+        found, globs = self.index.lookup(DNSLabel(name), qtype)
+        return [str(rr.rdata) for rr in found], [str(rr.rdata) for rr in globs]
+
+    def test_exact_and_glob(self):
+        # the resolver answers with the exact records if there are any
+        self.assertEqual(self.lookup("www"), (["192.0.2.1"], ["192.0.2.9"]))
+        self.assertEqual(self.lookup("nothing"), ([], ["192.0.2.9"]))
+
+    def test_absolute_answers(self):
+        found, globs = self.index.lookup(DNSLabel("www"), QTYPE.A)
+        self.assertEqual(str(found[0].rname), "www.lxd.example.")
+
+    def test_case_folding(self):
+        self.assertEqual(self.lookup("WWW")[0], ["192.0.2.1"])
+        self.assertEqual(self.lookup("mixed")[0], ["192.0.2.2"])
+        self.assertEqual(self.lookup("A.Web")[1], ["192.0.2.10"])
+
+    def test_multi_label_glob(self):
+        self.assertEqual(self.lookup("a.b.web")[1], ["192.0.2.10"])
+
+    def test_mid_name_glob(self):
+        self.assertEqual(self.lookup("db-1", QTYPE.AAAA), ([], ["2001:db8::1"]))
+        self.assertEqual(self.lookup("web-1", QTYPE.AAAA), ([], []))
+
+    def test_cname(self):
+        self.assertEqual(self.lookup("alias"), (["www.lxd.example."], ["192.0.2.9"]))
+        self.assertEqual(self.lookup("alias", QTYPE.CNAME)[0], ["www.lxd.example."])
+
+    def test_update_and_remove(self):
+        extra = self.entries["www"]
+        extra.entry = "www 60 IN A 192.0.2.3"
+        extra.save()
+        self.index.update("zoneextra", extra.pk)
+        self.assertEqual(self.lookup("www")[0], ["192.0.2.3"])
+
+        self.index.remove("zoneextra", extra.pk)
+        self.assertEqual(self.lookup("www")[0], [])
+
+    def test_rebuild_reports_changes(self):
+        self.assertFalse(self.index.rebuild())
+        ZoneExtra.objects.create(entry="new 60 IN A 192.0.2.4")
+        self.assertTrue(self.index.rebuild())
+        self.assertEqual(self.lookup("new")[0], ["192.0.2.4"])
+        self.assertFalse(self.index.rebuild())
+
+        containers = ContainerIndex()
+        self.assertTrue(containers.rebuild())
+        self.assertFalse(containers.rebuild())
+
+
+@mock.patch("apps.dns.cache.time.monotonic")
+class ResponseCacheTest(SimpleTestCase):
+
+    def test_ttl_countdown(self, monotonic):
+        cache = ResponseCache()
+        request, reply = answered(ttl=60)
+        monotonic.return_value = 100
+        cache.put(request, reply)
+
+        monotonic.return_value = 130
+        self.assertEqual(cache.get(request).rr[0].ttl, 30)
+        monotonic.return_value = 161
+        self.assertIsNone(cache.get(request))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_question_rewritten(self, monotonic):
+        monotonic.return_value = 100
+        cache = ResponseCache()
+        cache.put(*answered())
+
+        request = DNSRecord.question("EXAMPLE.org", "A")
+        reply = cache.get(request)
+        self.assertEqual(reply.header.id, request.header.id)
+        self.assertEqual(str(reply.q.qname), "EXAMPLE.org.")
+        self.assertEqual(str(reply.rr[0].rdata), "192.0.2.1")
+        self.assertIsNone(cache.get(DNSRecord.question("example.org", "AAAA")))
+
+    def test_negative_from_soa(self, monotonic):
+        cache = ResponseCache()
+        # the smaller of the SOA ttl and its minimum
+        self.assertEqual(cache.ttl(negative()[1]), 60)
+        self.assertEqual(cache.ttl(negative(rcode=RCODE.NOERROR)[1]), 60)
+        self.assertEqual(cache.ttl(negative(soa=False)[1]), 0)
+        self.assertEqual(cache.ttl(negative(rcode=RCODE.SERVFAIL)[1]), 0)
+
+        monotonic.return_value = 100
+        request, reply = negative()
+        cache.put(request, reply)
+        self.assertEqual(cache.get(request).header.rcode, RCODE.NXDOMAIN)
+
+    def test_truncated_not_cached(self, monotonic):
+        monotonic.return_value = 100
+        cache = ResponseCache()
+        request, reply = answered()
+        reply.header.tc = 1
+        cache.put(request, reply)
+        self.assertIsNone(cache.get(request))
+
+    def test_max_ttl(self, monotonic):
+        self.assertEqual(ResponseCache(max_ttl=3600).ttl(answered(ttl=86400)[1]), 3600)
+
+    def test_lru_eviction(self, monotonic):
+        monotonic.return_value = 100
+        cache = ResponseCache(size=2)
+        first, second, third = answered("a.example.org"), answered("b.example.org"), answered("c.example.org")
+        cache.put(*first)
+        cache.put(*second)
+        cache.get(first[0])
+        cache.put(*third)
+        self.assertIsNone(cache.get(second[0]))
+        self.assertIsNotNone(cache.get(first[0]))
+        self.assertEqual(cache.evictions, 1)
+
+
+def big(name="example.org", count=60):
+    request, reply = answered(name)
+    for i in range(count):
+        reply.add_answer(RR(name, QTYPE.A, rdata=A("198.51.100.%d" % i), ttl=60))
+    return request, reply
+
+
+class AnswerTemplatesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.templates = AnswerTemplates()
+        self.templates.put(*answered(), 1)
+
+    def test_hit_copies_id_flags_and_question(self):
+        request = DNSRecord.question("Example.ORG", "A")
+        request.header.rd = 0
+        reply = DNSRecord.parse(self.templates.get(request.pack(), 1))
+        self.assertEqual(reply.header.id, request.header.id)
+        self.assertEqual(reply.header.rd, 0)
+        self.assertEqual(str(reply.q.qname), "Example.ORG.")
+        self.assertEqual([str(rr.rdata) for rr in reply.rr], ["192.0.2.1"])
+
+    def test_generation(self):
+        self.assertIsNone(self.templates.get(DNSRecord.question("example.org", "A").pack(), 2))
+
+    def test_question_key(self):
+        for other in (DNSRecord.question("example.org", "AAAA"), DNSRecord.question("www.example.org", "A"),
+                      DNSRecord.question("example.org", "A", "CH")):
+            self.assertIsNone(self.templates.get(other.pack(), 1))
+
+    def test_only_plain_queries(self):
+        request, reply = answered()
+        self.assertIsNone(parse_question(reply.pack()))
+        self.assertEqual(read_question(reply.pack()), read_question(request.pack()))
+        two = DNSRecord.question("example.org", "A")
+        two.add_question(*DNSRecord.question("example.com", "A").questions)
+        self.assertIsNone(parse_question(two.pack()))
+        self.assertIsNone(parse_question(b"\x00" * 12))
+
+
+class FixedResolver(object):
+
+    def __init__(self, template, reply):
+        self.template = template
+        self.reply = reply
+
+    def cached_reply(self, data):
+        return self.template
+
+    async def resolve_async(self, request):
+        return self.reply
+
+
+class AsyncServerTruncationTest(SimpleTestCase):
+
+    def get_reply(self, udplen, udp):
+        request, reply = big()
+        server = AsyncDNSServer(FixedResolver(reply.pack(), reply), udplen=udplen)
+        return DNSRecord.parse(asyncio.run(server.get_reply(request.pack(), udp=udp)))
+
+    def test_truncated_over_udp(self):
+        reply = self.get_reply(512, udp=True)
+        self.assertEqual(reply.header.tc, 1)
+        self.assertEqual(len(reply.rr), 0)
+
+    def test_complete_over_tcp(self):
+        reply = self.get_reply(512, udp=False)
+        self.assertEqual(reply.header.tc, 0)
+        self.assertEqual(len(reply.rr), 61)
+
+    def test_fitting_template(self):
+        self.assertEqual(len(self.get_reply(4096, udp=True).rr), 61)
+
+
+def trie_match(patterns, name, rtype=QTYPE.A):
+    trie = GlobTrie()
+    for pattern in patterns:
+        suffix, glob = split_glob(name_key(DNSLabel(pattern)))
+        trie.add(suffix, glob, QTYPE.A, pattern)
+    return trie.match(name_key(DNSLabel(name)), [rtype])
+
+
+class GlobTrieTest(SimpleTestCase):
+
+    def test_same_as_whole_name_glob(self):
+        # a single pattern matches exactly the names DNSLabel.matchGlob matched before
+        patterns = ["*", "*.web", "www.*.web", "db-*.prod", "node?.web", "db[12].prod", "*.*.deep", "a*c.x", "*.Web"]
+        names = ["web", "a.web", "a.b.web", "www.a.web", "www.a.b.web", "WWW.A.Web", "db-1.prod", "db-1.x.prod",
+                 "web-1.prod", "node1.web", "node12.web", "db2.prod", "db3.prod", "x.y.deep", "y.deep", "abc.x",
+                 "ac.x", "a.c.x", "other"]
+        for pattern in patterns:
+            for name in names:
+                expected = fnmatch(name.lower() + ".", pattern.lower() + ".")
+                self.assertEqual(bool(trie_match([pattern], name)), expected, (pattern, name))
+
+    def test_most_specific(self):
+        self.assertEqual(trie_match(["*", "*.web", "*.a.web"], "x.a.web"), ["*.a.web"])
+        self.assertEqual(trie_match(["*", "*.web", "*.a.web"], "x.b.web"), ["*.web"])
+        self.assertEqual(trie_match(["*", "*.web"], "x.other"), ["*"])
+        # patterns of the same node all answer
+        self.assertEqual(trie_match(["db-*", "*"], "db-1"), ["db-*", "*"])
+
+    def test_plain_names(self):
+        self.assertIsNone(split_glob(name_key(DNSLabel("www.web"))))
+
+    def test_rtype(self):
+        self.assertEqual(trie_match(["*.web"], "a.web", QTYPE.AAAA), [])
+
+    def test_discard(self):
+        trie = GlobTrie()
+        suffix, glob = split_glob(name_key(DNSLabel("*.web")))
+        answer = object()
+        trie.add(suffix, glob, QTYPE.A, answer)
+        trie.discard(suffix, answer)
+        self.assertEqual(trie.match(name_key(DNSLabel("a.web")), [QTYPE.A]), [])
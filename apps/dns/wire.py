@@ -0,0 +1,81 @@
+import struct
+import threading
+
+
+def encode_name(label):
+    """
+    lowercased uncompressed wire format of a DNSLabel
+    """
+    return b"".join(bytes([len(part)]) + part.lower() for part in label.label) + b"\x00"
+
+
+def read_question(data):
+    """
+    (key, end of the question section) of a raw message with a single uncompressed
+    question, None otherwise. The key is (lowercased wire name, qtype, qclass).
+    """
+    if len(data) < 17 or data[4:6] != b"\x00\x01":
+        return None
+    pos = 12
+    while data[pos]:
+        if data[pos] & 0xC0:
+            return None
+        pos += data[pos] + 1
+        if pos + 5 > len(data):
+            return None
+    end = pos + 5
+    qtype, qclass = struct.unpack("!HH", data[pos + 1:end])
+    return (data[12:pos + 1].lower(), qtype, qclass), end
+
+
+def parse_question(data):
+    """
+    read_question of a raw standard query without answer records, None for everything else
+    """
+    if len(data) < 17 or data[2] & 0xF8 or data[4:10] != b"\x00\x01\x00\x00\x00\x00":
+        return None
+    return read_question(data)
+
+
+class AnswerTemplates(object):
+    """
+    Packed replies of locally answered questions.
+
+    A hit only copies the transaction id, the RD flag and the question (which has
+    the same length, the name only differs in case) of the request into the
+    template. Templates are tagged with the data generation they were built from
+    and are ignored once the generation moved on.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, data, generation):
+        question = parse_question(data)
+        if question is None:
+            return None
+        key, end = question
+        template = self._templates.get(key)
+        if template is None or template[0] != generation:
+            return None
+        packet = template[1]
+        flags = (packet[2] & 0xFE) | (data[2] & 0x01)
+        return data[:2] + bytes([flags]) + packet[3:12] + data[12:end] + packet[end:]
+
+    def put(self, request, reply, generation):
+        if len(request.questions) != 1:
+            return
+        q = request.q
+        key = (encode_name(q.qname), q.qtype, q.qclass)
+        packet = reply.pack()
+        with self._lock:
+            if key not in self._templates and len(self._templates) >= self.size:
+                # dicts keep insertion order, drop the oldest template
+                self._templates.pop(next(iter(self._templates)))
+            self._templates[key] = (generation, packet)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
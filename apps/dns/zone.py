@@ -0,0 +1,253 @@
+import threading
+from fnmatch import fnmatch
+
+from dnslib import RR, QTYPE, A, AAAA
+from dnslib.label import DNSLabel
+
+from apps.container.models import Container
+
+from .models import ZoneExtra, DynamicEntry
+
+GLOB_CHARS = (b"*", b"?", b"[")
+
+
+def name_key(label):
+    """
+    normalized lookup key of a (relative) DNSLabel: lowercased label tuple
+    """
+    return tuple(part.lower() for part in label.label)
+
+
+def split_glob(key):
+    """
+    split a name key into the literal labels right of the last label with glob
+    characters (reversed) and the glob pattern left of them, None for plain names
+    """
+    for i in range(len(key) - 1, -1, -1):
+        if any(c in key[i] for c in GLOB_CHARS):
+            return tuple(reversed(key[i + 1:])), b".".join(key[:i + 1]).decode(errors="replace")
+    return None
+
+
+class GlobTrie(object):
+    """
+    Wildcard records in a trie over the reversed literal labels of their names,
+    e.g. `*.web.project` is stored below project -> web with the pattern `*`.
+
+    A lookup walks the labels of the name from the right and fnmatches the
+    remaining labels only against the patterns of the nodes on its way, the
+    deepest (most specific) node with a match wins. `*` also matches several
+    labels, like the plain glob over the whole name did.
+    """
+
+    __slots__ = ("children", "globs")
+
+    def __init__(self):
+        self.children = {}
+        self.globs = ()
+
+    def add(self, suffix, pattern, rtype, answer):
+        node = self
+        for label in suffix:
+            node = node.children.setdefault(label, GlobTrie())
+        node.globs = node.globs + ((pattern, rtype, answer),)
+
+    def discard(self, suffix, answer):
+        node = self
+        for label in suffix:
+            node = node.children.get(label)
+            if node is None:
+                return
+        node.globs = tuple(g for g in node.globs if g[2] is not answer)
+
+    def match(self, key, rtypes):
+        found = []
+        node = self
+        depth = 0
+        while depth < len(key):
+            if node.globs:
+                rest = b".".join(key[:len(key) - depth]).decode(errors="replace")
+                matches = [answer for pattern, rtype, answer in node.globs
+                           if rtype in rtypes and fnmatch(rest, pattern)]
+                if matches:
+                    found = matches
+            node = node.children.get(key[len(key) - 1 - depth])
+            if node is None:
+                break
+            depth += 1
+        return found
+
+
+class ZoneIndex(object):
+    """
+    In-memory index of the ZoneExtra and DynamicEntry records.
+
+    Records are parsed once and kept by (name, rtype), names relative to the origin.
+    Entries with glob characters are additionally kept in a GlobTrie.
+    Readers never take the lock: every value is an immutable tuple which is replaced
+    as a whole by the writers holding `lock`.
+    """
+
+    def __init__(self, origin):
+        self.origin = DNSLabel(origin)
+        self.lock = threading.Lock()
+        self._texts = {}
+        self._sources = {}
+        self._records = {}
+        self._globs = GlobTrie()
+
+    def _parse(self, zone):
+        try:
+            return RR.fromZone(zone)
+        except Exception as e:
+            print("unparsable zone entry %r:" % zone, e)
+            return []
+
+    def _combined(self, dyn):
+        try:
+            return dyn.combined
+        except TypeError:
+            return ""
+
+    def _load(self, model, pk):
+        """
+        zone text of a row, None if it does not exist
+        """
+        if model == "zoneextra":
+            extra = ZoneExtra.objects.filter(pk=pk).first()
+            return None if extra is None else extra.entry
+        dyn = DynamicEntry.objects.filter(pk=pk).first()
+        return None if dyn is None else self._combined(dyn)
+
+    def _entries(self, rrs):
+        entries = []
+        for rr in rrs:
+            key = (name_key(rr.rname), rr.rtype)
+            answer = RR(DNSLabel(rr.rname.label + self.origin.label), rr.rtype, rr.rclass, rr.ttl, rr.rdata)
+            entries.append((key, answer, split_glob(key[0])))
+        return entries
+
+    def _add(self, records, globs, entries):
+        for key, answer, glob in entries:
+            records[key] = records.get(key, ()) + (answer,)
+            if glob is not None:
+                globs.add(glob[0], glob[1], key[1], answer)
+
+    def rebuild(self):
+        """
+        reload all rows, returns whether any of them changed
+        """
+        texts = {}
+        for extra in ZoneExtra.objects.all():
+            texts[("zoneextra", extra.pk)] = extra.entry
+        for dyn in DynamicEntry.objects.all():
+            texts[("dynamicentry", dyn.pk)] = self._combined(dyn)
+        with self.lock:
+            if texts == self._texts:
+                return False
+
+        sources = dict((source, self._entries(self._parse(text) if text else [])) for source, text in texts.items())
+        records = {}
+        globs = GlobTrie()
+        for entries in sources.values():
+            self._add(records, globs, entries)
+
+        with self.lock:
+            self._texts = texts
+            self._sources = sources
+            self._records = records
+            self._globs = globs
+        return True
+
+    def _drop(self, source):
+        self._texts.pop(source, None)
+        for key, answer, glob in self._sources.pop(source, []):
+            remaining = tuple(a for a in self._records.get(key, ()) if a is not answer)
+            if remaining:
+                self._records[key] = remaining
+            else:
+                self._records.pop(key, None)
+            if glob is not None:
+                self._globs.discard(glob[0], answer)
+
+    def update(self, model, pk):
+        """
+        reload a single ZoneExtra ("zoneextra") or DynamicEntry ("dynamicentry") row
+        """
+        text = self._load(model, pk)
+        with self.lock:
+            self._drop((model, pk))
+            if text is None:
+                return True
+            entries = self._entries(self._parse(text) if text else [])
+            self._texts[(model, pk)] = text
+            self._sources[(model, pk)] = entries
+            self._add(self._records, self._globs, entries)
+        return True
+
+    def remove(self, model, pk):
+        with self.lock:
+            self._drop((model, pk))
+        return True
+
+    def lookup(self, rem, qtype):
+        """
+        returns the exact matches (absolute names) and the most specific wildcard
+        matches for the name `rem` relative to the origin. CNAMEs are always included.
+        """
+        key = name_key(rem)
+        rtypes = [qtype] if qtype == QTYPE.CNAME else [qtype, QTYPE.CNAME]
+        found = []
+        for rtype in rtypes:
+            found += self._records.get((key, rtype), ())
+        return found, self._globs.match(key, rtypes)
+
+
+class ContainerIndex(object):
+    """
+    Answer sets of all containers: name -> (A rdata, AAAA rdata).
+
+    IPv6 addresses with a SIIT mapping contribute the mapped IPv4 address to the
+    A set. Built from a single joined query and swapped as a whole on rebuild.
+    """
+
+    def __init__(self):
+        self._rows = None
+        self._answers = {}
+
+    def rebuild(self):
+        """
+        reload all containers, returns whether their answers changed
+        """
+        rows = list(Container.objects.order_by("id", "ip__id", "ip__siit_ip__id").values_list(
+            "id", "name", "ip__id", "ip__ip", "ip__siit_ip__ip"))
+        if rows == self._rows:
+            return False
+
+        answers = {}
+        owner = {}
+        seen = set()
+        for ct_id, name, ip_id, ip, siit in rows:
+            # like filter(name=...).first(), the oldest container wins a name
+            if owner.setdefault(name, ct_id) != ct_id:
+                continue
+            a, aaaa = answers.setdefault(name, ([], []))
+            if ip is None or ip_id in seen:
+                continue
+            seen.add(ip_id)
+            if ":" not in ip:
+                a.append(A(ip))
+            else:
+                aaaa.append(AAAA(ip))
+                if siit is not None:
+                    a.append(A(siit))
+
+        self._answers = {name: (tuple(a), tuple(aaaa)) for name, (a, aaaa) in answers.items()}
+        self._rows = rows
+        return True
+
+    def lookup(self, name):
+        """
+        (A rdata, AAAA rdata) of the container, None if there is no such container
+        """
+        return self._answers.get(name)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class HostConfig(AppConfig):
     name = 'apps.host'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,180 @@
+import itertools
+import threading
+import time
+
+from django.conf import settings
+
+# tokens of a fresh counter (e.g. after redis lost its data) start at the time in
+# microseconds, above the tokens handed out before
+ACQUIRE = """
+local token = redis.call("incr", KEYS[2])
+if token == 1 then
+    token = redis.call("incrby", KEYS[2], ARGV[2])
+end
+if redis.call("set", KEYS[1], token, "NX", "PX", ARGV[1]) then
+    return token
+end
+return false
+"""
+
+# only extend or drop the lock while it still holds our token
+RENEW = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class RedisLocks(object):
+    """
+    Leases in redis: SET NX PX holding a fencing token from INCR.
+    """
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self._acquire = self.redis.register_script(ACQUIRE)
+        self._renew = self.redis.register_script(RENEW)
+        self._release = self.redis.register_script(RELEASE)
+
+    def acquire(self, name, ttl):
+        return self._acquire(keys=["lock:%s" % name, "lock-token:%s" % name],
+                             args=[int(ttl * 1000), int(time.time() * 1000000)])
+
+    def renew(self, name, token, ttl):
+        return bool(self._renew(keys=["lock:%s" % name], args=[token, int(ttl * 1000)]))
+
+    def release(self, name, token):
+        self._release(keys=["lock:%s" % name], args=[token])
+
+    def held(self, name):
+        return bool(self.redis.exists("lock:%s" % name))
+
+
+class LocalLocks(object):
+    """
+    Leases within this process, for tests and single worker setups.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._tokens = itertools.count(int(time.time() * 1000000))
+
+    def acquire(self, name, ttl):
+        with self._lock:
+            token = next(self._tokens)
+            holder = self._leases.get(name)
+            if holder is not None and holder[1] > time.monotonic():
+                return None
+            self._leases[name] = (token, time.monotonic() + ttl)
+            return token
+
+    def renew(self, name, token, ttl):
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is None or holder[0] != token or holder[1] <= time.monotonic():
+                return False
+            self._leases[name] = (token, time.monotonic() + ttl)
+            return True
+
+    def release(self, name, token):
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is not None and holder[0] == token:
+                del self._leases[name]
+
+    def held(self, name):
+        with self._lock:
+            holder = self._leases.get(name)
+            return holder is not None and holder[1] > time.monotonic()
+
+
+_backend = None
+
+
+def backend():
+    """
+    lock backend of LXD_LOCK_URL, "memory://" keeps the locks in this process
+    """
+    global _backend
+    if _backend is None:
+        url = getattr(settings, "LXD_LOCK_URL") or getattr(settings, "CELERY_BROKER_URL")
+        _backend = LocalLocks() if url.startswith("memory://") else RedisLocks(url)
+    return _backend
+
+
+class Lease(object):
+    """
+    Lock with an expiry which a thread renews every third of the ttl while it is held.
+
+    Each acquisition gets a larger token than all before, writers compare it
+    against the last token they saw (fencing) to reject a holder which lost its
+    lease unnoticed. A crashed holder stops renewing and its lease ends after the ttl.
+    """
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.token = None
+        self.lost = False
+        self._renewed = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        self._renewed = time.monotonic()
+        self.token = backend().acquire(self.name, self.ttl)
+        if self.token is None:
+            return False
+        self._thread = threading.Thread(target=self._keep, daemon=True)
+        self._thread.start()
+        return True
+
+    def _keep(self):
+        while not self._stop.wait(self.ttl / 3):
+            started = time.monotonic()
+            try:
+                renewed = backend().renew(self.name, self.token, self.ttl)
+            except Exception as e:
+                print("renewing lock %s failed:" % self.name, e)
+                continue
+            if not renewed:
+                print("lost lock %s" % self.name)
+                self.lost = True
+                return
+            self._renewed = started
+
+    def valid(self):
+        """
+        whether the lease is still ours: not lost and renewed within the ttl
+        """
+        return self.token is not None and not self.lost and time.monotonic() - self._renewed < self.ttl
+
+    def check(self):
+        """
+        raise LeaseLost unless the lease is valid, call it before writes which need it
+        """
+        if not self.valid():
+            raise LeaseLost(self.name)
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            backend().release(self.name, self.token)
+        except Exception as e:
+            print("releasing lock %s failed:" % self.name, e)
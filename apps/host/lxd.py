@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+import urllib3
+from django.conf import settings
+from pylxd import Client
+from pylxd.client import _APINode
+from requests.adapters import HTTPAdapter
+
+# (host id, timeout) -> (endpoint and certificates, client, last use)
+_clients = {}
+_lock = threading.Lock()
+
+
+def _identity(host):
+    """
+    what a client was built from: the endpoint and the modification times of the certificates
+    """
+    stamps = []
+    for path in (getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY"), getattr(settings, "LXD_CA_CERT")):
+        try:
+            stamps.append(os.stat(path).st_mtime_ns if isinstance(path, str) else path)
+        except OSError:
+            stamps.append(None)
+    return (host.api_url,) + tuple(stamps)
+
+
+class _PooledNode(_APINode):
+    """
+    API node whose children (client.api.containers[name].state, ...) share its
+    session and with it the connection pool, pylxd gives each one a new session
+    """
+
+    def __getattr__(self, name):
+        node = super().__getattr__(name)
+        node.session = self.session
+        return node
+
+    def __getitem__(self, item):
+        node = super().__getitem__(item)
+        node.session = self.session
+        return node
+
+
+def _build(host, timeout):
+    client = Client(endpoint=host.api_url, cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")),
+                    verify=getattr(settings, "LXD_CA_CERT"), timeout=timeout)
+
+    if not getattr(settings, "LXD_CA_CERT"):
+        urllib3.disable_warnings()
+
+    # keep enough connections alive for the concurrent requests of a sync
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=getattr(settings, "LXD_POOL_SIZE"))
+    client.api.session.mount("https://", adapter)
+    client.api.session.mount("http://", adapter)
+    client.api.__class__ = _PooledNode
+    return client
+
+
+def _healthy(host, client):
+    try:
+        client.api.get()
+        return True
+    except Exception as e:
+        print("dropping lxd client of %s:" % host.name, e)
+        return False
+
+
+def get_client(host, timeout=None):
+    """
+    pylxd client of host, shared by everything in this process.
+
+    Clients keep their HTTP connections alive. They are built again when the
+    api_url or the certificates changed and are checked with a /1.0 request
+    when they were idle for LXD_CLIENT_CHECK seconds.
+    """
+    key = (host.pk, timeout)
+    identity = _identity(host)
+    now = time.monotonic()
+    with _lock:
+        entry = _clients.get(key)
+    if entry is not None and entry[0] == identity:
+        if now - entry[2] < getattr(settings, "LXD_CLIENT_CHECK") or _healthy(host, entry[1]):
+            with _lock:
+                _clients[key] = (identity, entry[1], now)
+            return entry[1]
+
+    client = _build(host, timeout)
+    with _lock:
+        _clients[key] = (identity, client, now)
+    return client
+
+
+def invalidate(host_id):
+    """
+    forget the clients of a host, e.g. after it was changed
+    """
+    with _lock:
+        for key in [k for k in _clients if k[0] == host_id]:
+            del _clients[key]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.6 on 2026-10-18 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host', '0011_image_remove'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='last_sync_duration',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='next_sync',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='sync_interval',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='sync_queued',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host', '0012_auto_20261018_1015'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='host',
+            name='syncing',
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='sync_token',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
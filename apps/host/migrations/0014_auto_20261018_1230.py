@@ -0,0 +1,45 @@
+# Generated by Django 3.0.6 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+def dedupe_fingerprints(apps, schema_editor):
+    """
+    merge images with the same fingerprint into the oldest one, empty fingerprints become NULL
+    """
+    Image = apps.get_model('host', 'Image')
+    Image.objects.filter(fingerprint="").update(fingerprint=None)
+
+    first = {}
+    for image in Image.objects.exclude(fingerprint=None).order_by("id"):
+        keep = first.setdefault(image.fingerprint, image)
+        if keep is image:
+            continue
+        keep.available.add(*image.available.all())
+        keep.sync = keep.sync or image.sync
+        keep.remove = keep.remove or image.remove
+        keep.server = keep.server or image.server
+        keep.alias = keep.alias or image.alias
+        keep.save()
+        image.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host', '0013_auto_20261018_1100'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='fingerprint',
+            field=models.CharField(max_length=100, null=True),
+        ),
+        migrations.RunPython(dedupe_fingerprints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='image',
+            name='fingerprint',
+            field=models.CharField(max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.6 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host', '0015_changecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='sync_started',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
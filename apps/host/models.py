@@ -1,7 +1,9 @@
 import json
 from ipaddress import IPv4Network, ip_network
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Now
 
 # Create your models here.
 
@@ -25,12 +27,38 @@ class Host(models.Model):
     name = models.CharField(max_length=100)
     subnet = models.ForeignKey(Subnet, on_delete=models.SET_NULL, null=True)
     api_url = models.CharField(max_length=1000, null=True)
-    syncing = models.DateTimeField(null=True)
     monitoring_url = models.CharField(max_length=1000, null=True)
 
+    # sync scheduling, see apps.container.tasks.synclxd
+    last_sync_duration = models.FloatField(null=True)
+    sync_interval = models.PositiveIntegerField(null=True)
+    next_sync = models.DateTimeField(null=True)
+    sync_queued = models.DateTimeField(null=True)
+    # when the queued sync got its lease, None while it waits in the queue
+    sync_started = models.DateTimeField(null=True)
+    # fencing token of the last sync lock holder which wrote
+    sync_token = models.BigIntegerField(default=0)
+
     def __str__(self):
         return f"{self.name} in {self.subnet} at {self.api_url}"
 
+    @staticmethod
+    def container_stats(hosts):
+        """
+        {host id: {"used_memory": bytes, "container_states": {status code: count}}} of
+        hosts (ids or a queryset) from a single grouped query, hosts without containers are missing
+        """
+        stats = {}
+        rows = Host.objects.filter(pk__in=hosts).order_by().values("pk", "container__status_code") \
+            .annotate(count=Count("container"), memory=Sum("container__memory_usage"))
+        for row in rows:
+            if not row["count"]:
+                continue
+            host = stats.setdefault(row["pk"], {"used_memory": 0, "container_states": {}})
+            host["used_memory"] += row["memory"] or 0
+            host["container_states"][row["container__status_code"]] = row["count"]
+        return stats
+
 
 class Image(models.Model):
     SIMPLESTREAMS = "simplestreams"
@@ -38,7 +66,7 @@ class Image(models.Model):
     PROTOCOL = ((SIMPLESTREAMS, 'simplestreams'), (LXD, 'lxd'))
 
     properties = models.TextField()
-    fingerprint = models.CharField(max_length=100)
+    fingerprint = models.CharField(max_length=100, null=True, unique=True)
 
     available = models.ManyToManyField(Host)
     sync = models.BooleanField(default=False)
@@ -55,3 +83,32 @@ class Image(models.Model):
         except Exception as e:
             print(e)
             return ""
+
+
+class ChangeCounter(models.Model):
+    """
+    Counts the changes of the rows behind an API list ("container", "host", ...),
+    the source of the ETag and Last-Modified headers of its responses.
+    """
+    scope = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+    modified = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def bump(cls, *scopes):
+        """
+        count a change in scopes once the current transaction commits
+        """
+        transaction.on_commit(lambda: cls._bump(scopes))
+
+    @classmethod
+    def _bump(cls, scopes):
+        if cls.objects.filter(scope__in=scopes).update(value=F("value") + 1, modified=Now()) < len(scopes):
+            cls.objects.bulk_create([cls(scope=scope, value=1) for scope in scopes], ignore_conflicts=True)
+
+    @classmethod
+    def current(cls, scope):
+        """
+        (value, modified) of scope, modified is None for scopes which never changed
+        """
+        return cls.objects.filter(scope=scope).values_list("value", "modified").first() or (0, None)
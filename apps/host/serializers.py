@@ -1,19 +1,19 @@
-import json
-
 from rest_framework import serializers
 
+from apps.account.drf import SparseFieldsMixin
+
 from .models import Host, Image, Subnet
 from .tasks import authenticate_host
 
 
-class SubnetSerializer(serializers.ModelSerializer):
+class SubnetSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Subnet
         fields = ('id', 'ip', 'prefixlen')
 
 
-class ImageSerializer(serializers.ModelSerializer):
+class ImageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     available = serializers.HyperlinkedRelatedField(many=True, view_name='host-detail', read_only=True)
 
     class Meta:
@@ -24,21 +24,24 @@ class ImageSerializer(serializers.ModelSerializer):
                         'fingerprint': {'required': False}}
 
 
-class HostSerializer(serializers.ModelSerializer):
+class HostSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     subnet = serializers.HyperlinkedRelatedField(view_name='subnet-detail', queryset=Subnet.objects.all())
     trust_password = serializers.CharField(write_only=True, required=False)
     used_memory = serializers.SerializerMethodField('get_memory')
     images = serializers.HyperlinkedRelatedField(many=True, view_name='image-detail', read_only=True, source='image_set')
 
+    def get_container_stats(self, host: Host):
+        """
+        container aggregates of host, from the "container_stats" of the context
+        which views of many hosts fill with Host.container_stats
+        """
+        stats = self.context.get("container_stats")
+        if stats is None:
+            stats = Host.container_stats([host.pk])
+        return stats.get(host.pk, {"used_memory": 0, "container_states": {}})
+
     def get_memory(self, obj: Host):
-        m = 0
-        for ct in obj.container_set.all():
-            try:
-                st = json.loads(ct.state)
-                m += st["memory"]["usage"]
-            except Exception:
-                pass
-        return m
+        return self.get_container_stats(obj)["used_memory"]
 
     class Meta:
         model = Host
@@ -57,13 +60,7 @@ class HostFatSerializer(HostSerializer):
         fields = ('id', 'url', 'name', 'subnet', 'api_url', 'trust_password', 'used_memory', 'monitoring_url', 'images', 'container_states')
 
     def get_container_states(self, host):
-        states = {}
-        for c in host.container_set.all():
-            s = c.status_code
-            if s not in states:
-                states[s] = 0
-            states[s] += 1
-        return states
+        return self.get_container_stats(host)["container_states"]
 
 class HostSlimSerializer(HostSerializer):
     class Meta(HostSerializer.Meta):
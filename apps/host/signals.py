@@ -0,0 +1,28 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .lxd import invalidate
+from .models import ChangeCounter, Host, Image
+
+# API lists showing the rows of each model
+HOST_SCOPES = ("host", "container", "image")
+IMAGE_SCOPES = ("image", "host")
+
+
+@receiver(post_save, sender=Host)
+def host_saved(sender, instance, **kwargs):
+    invalidate(instance.pk)
+    ChangeCounter.bump(*HOST_SCOPES)
+
+
+@receiver(post_delete, sender=Host)
+def host_deleted(sender, instance, **kwargs):
+    invalidate(instance.pk)
+    ChangeCounter.bump(*HOST_SCOPES)
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+@receiver(m2m_changed, sender=Image.available.through)
+def image_changed(sender, instance, **kwargs):
+    ChangeCounter.bump(*IMAGE_SCOPES)
@@ -1,10 +1,14 @@
 from __future__ import absolute_import, unicode_literals
 
+import json
+
 from celery import shared_task
 from django.conf import settings
-from pylxd import Client
 
-from .models import Host
+from .locks import backend
+from .lxd import get_client, invalidate
+from .models import ChangeCounter, Host, Image
+from .signals import IMAGE_SCOPES
 
 
 @shared_task
@@ -12,8 +16,65 @@ def authenticate_host(host_id, pw):
 
     host = Host.objects.get(id=host_id)
 
-    client = Client(endpoint=host.api_url, cert=(getattr(settings, "LXD_CRT"), getattr(settings, "LXD_KEY")),
-                    verify=getattr(settings, "LXD_CA_CERT"), timeout=60)
+    client = get_client(host, timeout=60)
 
     if not client.trusted:
         client.authenticate(pw)
+        # the server info of the cached clients predates the trust
+        invalidate(host.id)
+
+
+def sync_images(client, host):
+    """
+    match the images of a host against the catalogue by fingerprint: records new
+    ones, deletes the ones flagged for removal, updates which images the host has
+    and queues pulls of missing synced aliases
+    """
+    listing = dict((image["fingerprint"], image)
+                   for image in client.api.images.get(params={"recursion": 1}).json()['metadata'])
+
+    known = set(Image.objects.filter(fingerprint__in=list(listing)).values_list("fingerprint", flat=True))
+    new = [Image(fingerprint=fingerprint, properties=json.dumps(image["properties"]))
+           for fingerprint, image in listing.items() if fingerprint not in known]
+    Image.objects.bulk_create(new, ignore_conflicts=True)
+
+    present = set()
+    available_aliases = []
+    for pk, fingerprint, remove in Image.objects.filter(fingerprint__in=list(listing)).values_list(
+            "id", "fingerprint", "remove"):
+        if remove:
+            client.api.images[fingerprint].delete()
+        else:
+            present.add(pk)
+            available_aliases += [a['name'] for a in listing[fingerprint]["aliases"]]
+
+    Available = Image.available.through
+    linked = set(Available.objects.filter(host=host).values_list("image_id", flat=True))
+    Available.objects.bulk_create([Available(image_id=pk, host_id=host.pk) for pk in present - linked],
+                                  ignore_conflicts=True)
+    Available.objects.filter(host=host, image_id__in=linked - present).delete()
+    if new or present != linked:
+        # bulk queries send no signals
+        ChangeCounter.bump(*IMAGE_SCOPES)
+
+    for image in Image.objects.filter(sync=True).exclude(alias__in=available_aliases):
+        # at most one pull of an image to a host queued or running
+        name = "pull:%s:%s" % (image.pk, host.pk)
+        token = backend().acquire(name, getattr(settings, "LXD_PULL_TIMEOUT"))
+        if token is not None:
+            pull_image.delay(image.pk, host.pk, token)
+
+
+@shared_task
+def pull_image(image_id, host_id, token):
+    try:
+        image = Image.objects.get(id=image_id)
+        client = get_client(Host.objects.get(id=host_id))
+        if image.protocol == Image.SIMPLESTREAMS:
+            client.images.create_from_simplestreams(image.server, alias=None, new_alias=image.alias, public=False, auto_update=True)
+        else:
+            client.images.create_from_image(image.server, alias=image.alias, public=False, auto_update=True)
+    except Exception as e:
+        print(e)
+    finally:
+        backend().release("pull:%s:%s" % (image_id, host_id), token)
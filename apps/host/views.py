@@ -1,6 +1,6 @@
 from rest_framework import viewsets
 
-from apps.account.drf import IsStaff, IsSuperuser, is_sudo
+from apps.account.drf import ConditionalMixin, IsStaff, IsSuperuser, is_sudo
 
 from .models import Host, Image, Subnet
 from .serializers import HostFatSerializer, ImageSerializer, SubnetSerializer, ImageFatSerializer
@@ -8,10 +8,12 @@ from .serializers import HostFatSerializer, ImageSerializer, SubnetSerializer, I
 # Create your views here.
 
 
-class HostViewSet(viewsets.ModelViewSet):
+class HostViewSet(ConditionalMixin, viewsets.ModelViewSet):
+    change_scope = 'host'
     serializer_class = HostFatSerializer
 
-    queryset = Host.objects.all()
+    # the container aggregates come from get_serializer_context
+    queryset = Host.objects.prefetch_related("image_set")
 
     def get_permissions(self):
         """
@@ -23,6 +25,12 @@ class HostViewSet(viewsets.ModelViewSet):
             permission_classes = [IsSuperuser]
         return [permission() for permission in permission_classes]
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action == 'list':
+            context["container_stats"] = Host.container_stats(self.filter_queryset(self.get_queryset()))
+        return context
+
 
 class SubnetViewSet(viewsets.ModelViewSet):
     serializer_class = SubnetSerializer
@@ -40,7 +48,8 @@ class SubnetViewSet(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
 
-class ImageViewSet(viewsets.ModelViewSet):
+class ImageViewSet(ConditionalMixin, viewsets.ModelViewSet):
+    change_scope = 'image'
     serializer_class = ImageSerializer
 
     def get_queryset(self):
@@ -56,6 +65,13 @@ class ImageViewSet(viewsets.ModelViewSet):
             serializer_class = ImageFatSerializer
         return serializer_class
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action == 'list':
+            # for the hosts nested in ImageFatSerializer
+            context["container_stats"] = Host.container_stats(Host.objects.all())
+        return context
+
     def get_permissions(self):
         """
         Instantiates and returns the list of permissions that this view requires.
@@ -8,7 +8,10 @@ AUTHENTICATION_BACKENDS = (
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'apps.account.drf.IsStaff',
-    ]
+    ],
+    # opt-in, see OptionalCursorPagination
+    'DEFAULT_PAGINATION_CLASS': 'apps.account.drf.OptionalCursorPagination',
+    'PAGE_SIZE': 100,
 }
 if os.environ.get('DJANGO_CSRF_EXCEPT', False):
     REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] = [
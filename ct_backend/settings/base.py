@@ -105,7 +105,7 @@ else:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'NAME': os.environ.get('DB_SQLITE_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
         }
     }
 
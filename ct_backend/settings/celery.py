@@ -11,7 +11,12 @@ CELERY_TIMEZONE = 'UTC'
 CELERY_BEAT_SCHEDULE = {
     'synclxd': {
         'task': 'apps.container.tasks.synclxd',
-        'schedule': 30,  # crontab(minute=59, hour=23),
+        # only queues the hosts which are due, see LXD_SYNC_INTERVAL
+        'schedule': int(os.environ.get("LXD_SCHEDULE_TICK", 30)),  # crontab(minute=59, hour=23),
         # 'args': (*args)
     },
+    'prune_changes': {
+        'task': 'apps.container.tasks.prune_changes',
+        'schedule': 600,
+    },
 }
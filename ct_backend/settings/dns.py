@@ -4,5 +4,24 @@ DNS_BASE_DOMAIN = os.environ.get('DNS_BASE_DOMAIN', ".")
 DNS_CONTAINER_DOMAIN = os.environ.get('DNS_CONTAINER_DOMAIN', ".")
 DNS_MIRROR_SERVER = os.environ.get('DNS_MIRROR_SERVER', "").strip()
 print("forwarding requests to: %s" % DNS_MIRROR_SERVER)
+# several upstreams can be given separated by spaces or commas, they are tried in order
+DNS_MIRROR_SERVERS = DNS_MIRROR_SERVER.replace(",", " ").split()
 if DNS_MIRROR_SERVER == "":
-    DNS_MIRROR_SERVER = None
\ No newline at end of file
+    DNS_MIRROR_SERVER = None
+# seconds to wait for each upstream
+DNS_FORWARD_TIMEOUT = float(os.environ.get('DNS_FORWARD_TIMEOUT', 2))
+
+# seconds between full reloads of the resolver's data, changes are pushed
+# through the notification channel, this only catches lost notifications
+DNS_ZONE_REFRESH = int(os.environ.get('DNS_ZONE_REFRESH', 300))
+
+# PostgreSQL LISTEN/NOTIFY channel, with SQLite a local UDP socket is used instead
+DNS_NOTIFY_CHANNEL = os.environ.get('DNS_NOTIFY_CHANNEL', 'lxd_dns')
+DNS_NOTIFY_ADDRESS = os.environ.get('DNS_NOTIFY_ADDRESS', '127.0.0.1:5380')
+
+# cache of forwarded replies, entries and the longest time a reply is kept
+DNS_CACHE_SIZE = int(os.environ.get('DNS_CACHE_SIZE', 10000))
+DNS_CACHE_MAX_TTL = int(os.environ.get('DNS_CACHE_MAX_TTL', 3600))
+
+# packed replies of locally answered questions kept for the fast path
+DNS_TEMPLATE_SIZE = int(os.environ.get('DNS_TEMPLATE_SIZE', 4096))
@@ -8,4 +8,56 @@ LXD_CA_CERT = os.environ.get('LXD_CA_CERT', 'certs/fakelerootx1.pem')
 if LXD_CA_CERT == 'False':
     LXD_CA_CERT = False
 elif LXD_CA_CERT == 'True':
-    LXD_CA_CERT = True
\ No newline at end of file
+    LXD_CA_CERT = True
+
+# LXD requests in flight per host while syncing
+LXD_SYNC_CONCURRENCY = int(os.environ.get('LXD_SYNC_CONCURRENCY', 16))
+
+# seconds between writes of the usage counters of otherwise unchanged containers
+LXD_COUNTERS_INTERVAL = int(os.environ.get('LXD_COUNTERS_INTERVAL', 60))
+
+# kept alive connections per host and seconds after which an idle client is checked
+LXD_POOL_SIZE = int(os.environ.get('LXD_POOL_SIZE', LXD_SYNC_CONCURRENCY))
+LXD_CLIENT_CHECK = int(os.environ.get('LXD_CLIENT_CHECK', 60))
+
+# set to True where `manage.py lxdevents` runs as a service next to the workers. Only
+# then the syncs back off to a slow reconciliation, otherwise they keep the 30s pace
+LXD_EVENTS = os.environ.get('LXD_EVENTS', 'False') == 'True'
+
+# seconds between the syncs of a host, adapted between min and max to how often it
+# changes, but at least LXD_SYNC_DUTY times the duration of its last sync
+LXD_SYNC_INTERVAL = int(os.environ.get('LXD_SYNC_INTERVAL', 300 if LXD_EVENTS else 30))
+LXD_SYNC_INTERVAL_MIN = int(os.environ.get('LXD_SYNC_INTERVAL_MIN', 60 if LXD_EVENTS else 30))
+LXD_SYNC_INTERVAL_MAX = int(os.environ.get('LXD_SYNC_INTERVAL_MAX', 1800 if LXD_EVENTS else 30))
+LXD_SYNC_DUTY = float(os.environ.get('LXD_SYNC_DUTY', 10))
+
+# a queued sync which did not start after this many seconds is considered lost, a
+# started one only once its lease (LXD_SYNC_LEASE) ran out
+LXD_SYNC_QUEUE_TIMEOUT = int(os.environ.get('LXD_SYNC_QUEUE_TIMEOUT', 900))
+
+# celery queues the hosts are sharded on (default queue if empty), hosts whose
+# last sync took longer than LXD_SYNC_SLOW seconds go to LXD_SYNC_SLOW_QUEUE
+LXD_SYNC_QUEUES = os.environ.get('LXD_SYNC_QUEUES', '').replace(",", " ").split()
+LXD_SYNC_SLOW_QUEUE = os.environ.get('LXD_SYNC_SLOW_QUEUE', None)
+LXD_SYNC_SLOW = float(os.environ.get('LXD_SYNC_SLOW', 60))
+
+# redis for the sync locks (the celery broker if unset), "memory://" for in-process locks,
+# and the lease time in seconds, renewed while a sync runs
+LXD_LOCK_URL = os.environ.get('LXD_LOCK_URL', None)
+LXD_SYNC_LEASE = int(os.environ.get('LXD_SYNC_LEASE', 30))
+
+# seconds a queued or running image pull blocks further pulls of the image to the host
+LXD_PULL_TIMEOUT = int(os.environ.get('LXD_PULL_TIMEOUT', 3600))
+
+# container event stream: seconds a long-poll waits at most, a stream stays open
+# (both below the gunicorn timeout), between the database polls of both and how
+# long the changes are kept
+CONTAINER_EVENTS_WAIT = int(os.environ.get('CONTAINER_EVENTS_WAIT', 25))
+CONTAINER_EVENTS_STREAM = int(os.environ.get('CONTAINER_EVENTS_STREAM', 55))
+CONTAINER_EVENTS_POLL = float(os.environ.get('CONTAINER_EVENTS_POLL', 1))
+CONTAINER_EVENTS_KEEP = int(os.environ.get('CONTAINER_EVENTS_KEEP', 3600))
+
+# open event streams per server process. Each holds a gunicorn thread for up to
+# CONTAINER_EVENTS_STREAM seconds (the Dockerfile runs 10 workers x 8 threads),
+# keep it well below the threads per worker. The clients beyond it poll instead.
+CONTAINER_EVENTS_STREAMS = int(os.environ.get('CONTAINER_EVENTS_STREAMS', 2))
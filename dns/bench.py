@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Benchmarks of the DNS resolver, by default against a freshly seeded SQLite
+    database in a temporary directory:
+
+        python dns/bench.py db --containers 2000 --queries 5000
+        python dns/bench.py load --duration 10 --concurrency 64 --transport both --server-args="--asyncio --workers 4"
+
+    `db` measures in-process query and reload latency, `load` starts dns/server.py
+    with a local upstream stand-in and fires a mix of queries at it over UDP/TCP.
+    Everything runs offline.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+DOMAIN = "lxd.bench."
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+    return {"n": len(samples), "mean": statistics.mean(samples), "p50": at(0.5), "p99": at(0.99), "p999": at(0.999)}
+
+
+def report(title, samples):
+    stats = percentiles(samples)
+    print("%-48s n=%-7d mean=%9.1fus p50=%9.1fus p99=%9.1fus p999=%9.1fus" % (
+        title, stats["n"], stats["mean"] * 1e6, stats["p50"] * 1e6, stats["p99"] * 1e6, stats["p999"] * 1e6))
+
+
+def seed(containers, extras):
+    """
+    fill the database with `containers` containers (one IPv4, one IPv6 each, every
+    tenth with a SIIT mapped IPv4), `extras` A records plus a tenth as many CNAME,
+    wildcard CNAME and DynamicEntry rows
+    """
+    from apps.container.models import IP, Container
+    from apps.dns.models import DynamicEntry, ZoneExtra
+    from apps.host.models import Host, Subnet
+
+    subnet = Subnet.objects.create(ip="10.0.0.0", prefixlen=8)
+    host = Host.objects.create(name="bench", subnet=subnet, api_url="https://127.0.0.1:8443")
+    Container.objects.bulk_create([Container(name="ct%d" % i, host=host, state='{"status_code": 103}')
+                                   for i in range(containers)])
+
+    ips = []
+    for i, ct_id in enumerate(Container.objects.order_by("id").values_list("id", flat=True)):
+        ips.append(IP(ip="10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), prefixlen=8, container_id=ct_id))
+        ips.append(IP(ip="fd00::%x" % (i + 1), prefixlen=64, container_id=ct_id, container_target_id=ct_id))
+    IP.objects.bulk_create(ips)
+    IP.objects.bulk_create([IP(ip="100.64.%d.%d" % (i >> 8 & 255, i & 255), prefixlen=10, siit_map_id=v6)
+                            for i, v6 in enumerate(IP.objects.filter(ip__startswith="fd00::")
+                                                   .order_by("id").values_list("id", flat=True)[::10])])
+
+    ZoneExtra.objects.bulk_create(
+        [ZoneExtra(entry="rec%d 60 IN A 192.0.2.%d" % (i, i % 250 + 1)) for i in range(extras)] +
+        [ZoneExtra(entry="alias%d 60 IN CNAME ct%d" % (i, i)) for i in range(extras // 10)] +
+        [ZoneExtra(entry="*.proj%d 60 IN CNAME ct%d" % (i, i)) for i in range(extras // 10)])
+    DynamicEntry.objects.bulk_create([DynamicEntry(format="dyn%d 60 IN TXT %%s" % i, value="v%d" % i)
+                                      for i in range(extras // 10)])
+
+
+def names(args):
+    """
+    a mix of container, zone entry and wildcard names inside of the zone
+    """
+    mix = []
+    for _ in range(args.queries):
+        kind = random.random()
+        if kind < 0.6:
+            mix.append(("ct%d" % random.randrange(args.containers), "A"))
+        elif kind < 0.8:
+            mix.append(("ct%d" % random.randrange(args.containers), "AAAA"))
+        elif kind < 0.95:
+            mix.append(("rec%d" % random.randrange(max(args.extras, 1)), "A"))
+        else:
+            mix.append(("x.proj%d" % random.randrange(max(args.extras // 10, 1)), "A"))
+    return mix
+
+
+def legacy_answer(resolver, request):
+    """
+    the query path before the in-memory indexes: table scans, per container
+    queries and closing the connections after every query
+    """
+    from dnslib import RR, QTYPE, A, AAAA
+    from dnslib.label import DNSLabel
+    from django.db import connections
+    from apps.container.models import Container
+    from apps.dns.models import ZoneExtra, DynamicEntry
+
+    reply = request.reply()
+    qname = request.q.qname
+    qtype = request.q.qtype
+    rem = resolver.relative(qname)
+
+    rrs = []
+    for extra in ZoneExtra.objects.all():
+        rrs += RR.fromZone(extra.entry)
+    for dyn in DynamicEntry.objects.all():
+        rrs += RR.fromZone(dyn.combined)
+    for rr in rrs:
+        if (rem == rr.rname or rem.matchGlob(rr.rname)) and rr.rtype in [qtype, QTYPE.CNAME]:
+            rr.rname = DNSLabel(rr.rname.label + resolver.origin.label)
+            reply.add_answer(rr)
+
+    cts = Container.objects.filter(name=str(rem)[:-1].lower())
+    if cts.exists():
+        ct = cts.first()
+        for ip in ct.ip_set.all():
+            if qtype == QTYPE.A and ip.is_ipv4:
+                reply.add_answer(RR(qname, QTYPE.A, ttl=resolver.ttl, rdata=A(ip.ip)))
+            elif qtype == QTYPE.A and ip.siit_ip.exists():
+                reply.add_answer(RR(qname, QTYPE.A, ttl=resolver.ttl, rdata=A(ip.siit_ip.first().ip)))
+            elif qtype == QTYPE.AAAA and not ip.is_ipv4:
+                reply.add_answer(RR(qname, QTYPE.AAAA, ttl=resolver.ttl, rdata=AAAA(ip.ip)))
+    connections.close_all()
+    return resolver.finish(reply)
+
+
+def bench_db(server, args):
+    from dnslib.dns import DNSRecord
+    from django.db import connections
+
+    resolver = server.LXDResolver(server.settings.DNS_CONTAINER_DOMAIN, '60s')
+    resolver.forwarder = None
+    requests = [DNSRecord.question("%s.%s" % (name, resolver.origin), qtype) for name, qtype in names(args)]
+
+    # the resolver prints every query
+    quiet = open(os.devnull, "w")
+
+    legacy = requests[:args.legacy_queries]
+    samples = []
+    with contextlib.redirect_stdout(quiet):
+        for request in legacy:
+            start = time.perf_counter()
+            legacy_answer(resolver, request)
+            samples.append(time.perf_counter() - start)
+    report("query, before (db lookups + close_all)", samples)
+
+    samples = []
+    with contextlib.redirect_stdout(quiet):
+        for request in requests:
+            start = time.perf_counter()
+            resolver.resolve(request, None)
+            samples.append(time.perf_counter() - start)
+    report("query, in-memory indexes", samples)
+
+    # resolve() above left templates for all of them
+    packets = [request.pack() for request in requests]
+    samples = []
+    with contextlib.redirect_stdout(quiet):
+        for data in packets:
+            start = time.perf_counter()
+            if resolver.cached_reply(data) is None:
+                resolver.resolve(DNSRecord.parse(data), None)
+            samples.append(time.perf_counter() - start)
+    report("query, packed templates", samples)
+
+    samples = []
+    for _ in range(args.reloads):
+        start = time.perf_counter()
+        resolver.containers.rebuild()
+        connections.close_all()
+        samples.append(time.perf_counter() - start)
+    report("container reload, reconnect every time", samples)
+
+    samples = []
+    for _ in range(args.reloads):
+        start = time.perf_counter()
+        resolver.db(resolver.containers.rebuild)
+        samples.append(time.perf_counter() - start)
+    report("container reload, persistent connection", samples)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_upstream(port, delay):
+    """
+    stand-in for DNS_MIRROR_SERVER: answers every A/AAAA question after `delay` seconds
+    """
+    from dnslib import RR, QTYPE, A, AAAA
+    from dnslib.server import BaseResolver, DNSLogger, DNSServer
+
+    class StandIn(BaseResolver):
+        def resolve(self, request, handler):
+            time.sleep(delay)
+            reply = request.reply()
+            if request.q.qtype == QTYPE.A:
+                reply.add_answer(RR(request.q.qname, QTYPE.A, ttl=300, rdata=A("198.51.100.1")))
+            elif request.q.qtype == QTYPE.AAAA:
+                reply.add_answer(RR(request.q.qname, QTYPE.AAAA, ttl=300, rdata=AAAA("2001:db8::1")))
+            return reply
+
+    logger = DNSLogger("-request,-reply,-truncated,-error")
+    DNSServer(StandIn(), port=port, address="127.0.0.1", logger=logger).start_thread()
+    DNSServer(StandIn(), port=port, address="127.0.0.1", tcp=True, logger=logger).start_thread()
+    while True:
+        time.sleep(1)
+
+
+def load_mix(args, domain):
+    """
+    (kind, packed query) pairs following --mix
+    """
+    from dnslib.dns import DNSRecord
+
+    extras = max(args.extras // 10, 1)
+    kinds = {
+        "A": lambda: ("ct%d" % random.randrange(args.containers), "A"),
+        "AAAA": lambda: ("ct%d" % random.randrange(args.containers), "AAAA"),
+        "CNAME": lambda: ("alias%d" % random.randrange(extras), "CNAME"),
+        "record": lambda: ("rec%d" % random.randrange(max(args.extras, 1)), "A"),
+        "wildcard": lambda: ("x%d.proj%d" % (random.randrange(100), random.randrange(extras)), "A"),
+        "forward": lambda: ("ext%d" % random.randrange(args.forward_names), "A"),
+    }
+    mix = []
+    for part in args.mix.split(","):
+        kind, _, weight = part.partition("=")
+        for _ in range(int(weight or 1)):
+            mix.append(kind)
+
+    queries = []
+    for _ in range(args.queries):
+        kind = random.choice(mix)
+        name, qtype = kinds[kind]()
+        queries.append((kind, DNSRecord.question("%s.%s" % (name, domain), qtype).pack()))
+    return queries
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.waiting = None
+
+    def datagram_received(self, data, addr):
+        if self.waiting is not None and data[:2] == self.waiting[0] and not self.waiting[1].done():
+            self.waiting[1].set_result(data)
+
+
+async def udp_client(server, queries, deadline, timeout, results):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(_ClientProtocol, remote_addr=server)
+    try:
+        while loop.time() < deadline:
+            kind, packet = random.choice(queries)
+            qid = struct.pack("!H", random.randrange(65536))
+            protocol.waiting = (qid, loop.create_future())
+            start = time.perf_counter()
+            transport.sendto(qid + packet[2:])
+            try:
+                await asyncio.wait_for(protocol.waiting[1], timeout)
+                results.setdefault(("udp", kind), []).append(time.perf_counter() - start)
+            except asyncio.TimeoutError:
+                results.setdefault(("udp", kind, "timeout"), []).append(timeout)
+    finally:
+        transport.close()
+
+
+async def tcp_client(server, queries, deadline, timeout, results):
+    loop = asyncio.get_running_loop()
+    reader, writer = await asyncio.open_connection(*server)
+    try:
+        while loop.time() < deadline:
+            kind, packet = random.choice(queries)
+            start = time.perf_counter()
+            writer.write(struct.pack("!H", len(packet)) + packet)
+            try:
+                length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), timeout))[0]
+                await asyncio.wait_for(reader.readexactly(length), timeout)
+                results.setdefault(("tcp", kind), []).append(time.perf_counter() - start)
+            except asyncio.TimeoutError:
+                results.setdefault(("tcp", kind, "timeout"), []).append(timeout)
+                break
+    finally:
+        writer.close()
+
+
+async def fire(server, queries, args):
+    results = {}
+    deadline = asyncio.get_running_loop().time() + args.duration
+    clients = []
+    for i in range(args.concurrency):
+        tcp = args.transport == "tcp" or (args.transport == "both" and i % 2)
+        clients.append((tcp_client if tcp else udp_client)(server, queries, deadline, args.timeout, results))
+    start = time.perf_counter()
+    await asyncio.gather(*clients)
+    return results, time.perf_counter() - start
+
+
+def wait_for_server(server, domain, timeout=60):
+    from dnslib.dns import DNSRecord
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            DNSRecord.question("ct0.%s" % domain).send(*server, timeout=0.5)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("dns server did not come up")
+
+
+def bench_load(args, domain, env):
+    upstream_port = free_port()
+    upstream = multiprocessing.Process(target=run_upstream, args=(upstream_port, args.upstream_delay), daemon=True)
+    upstream.start()
+
+    port = free_port()
+    env = dict(env, DNS_MIRROR_SERVER="127.0.0.1:%d" % upstream_port, DNS_NOTIFY_ADDRESS="127.0.0.1:%d" % free_port())
+    command = [sys.executable, os.path.join(HERE, "server.py"), "--address", "127.0.0.1", "--port", str(port), "--tcp",
+               "--log=-request,-reply,-truncated,-error"] + shlex.split(args.server_args)
+    print("starting", " ".join(command))
+    resolver = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_server(("127.0.0.1", port), domain)
+        queries = load_mix(args, domain)
+        results, elapsed = asyncio.run(fire(("127.0.0.1", port), queries, args))
+    finally:
+        resolver.terminate()
+        resolver.wait()
+        upstream.terminate()
+
+    answered = sum(len(v) for k, v in results.items() if len(k) == 2)
+    timeouts = sum(len(v) for k, v in results.items() if len(k) == 3)
+    print("%d queries in %.1fs: %.0f QPS, %d timeouts" % (answered, elapsed, answered / elapsed, timeouts))
+    report("all", [x for k, v in results.items() if len(k) == 2 for x in v])
+    for key in sorted(k for k in results if len(k) == 2):
+        report("%s %s" % key, results[key])
+
+
+if __name__ == '__main__':
+
+    p = argparse.ArgumentParser(description="DNS resolver benchmarks")
+    p.add_argument("mode", choices=["db", "load"],
+                   help="db: in-process query and reload latency, load: QPS and latency of a running server")
+    p.add_argument("--containers", type=int, default=1000, help="Seeded containers (default:1000)")
+    p.add_argument("--extras", type=int, default=1000, help="Seeded ZoneExtra rows (default:1000)")
+    p.add_argument("--queries", type=int, default=5000, help="Queries per measurement (default:5000)")
+    p.add_argument("--legacy-queries", type=int, default=200,
+                   help="Queries through the old database path (default:200)")
+    p.add_argument("--reloads", type=int, default=50, help="Data reloads per measurement (default:50)")
+    p.add_argument("--configured-db", action='store_true', default=False,
+                   help="Use the configured (already filled) database instead of a seeded SQLite one")
+    p.add_argument("--duration", type=float, default=10, help="load: seconds to fire queries (default:10)")
+    p.add_argument("--concurrency", type=int, default=32, help="load: queries in flight (default:32)")
+    p.add_argument("--transport", choices=["udp", "tcp", "both"], default="udp", help="load: (default:udp)")
+    p.add_argument("--mix", default="A=50,AAAA=20,CNAME=5,record=10,wildcard=5,forward=10",
+                   help="load: weighted query kinds out of A, AAAA, CNAME, record, wildcard, forward")
+    p.add_argument("--forward-names", type=int, default=1000, help="load: distinct forwarded names (default:1000)")
+    p.add_argument("--upstream-delay", type=float, default=0.0, help="load: upstream answer delay (default:0)")
+    p.add_argument("--timeout", type=float, default=2.0, help="load: seconds until a query counts as lost")
+    p.add_argument("--server-args", default="", help="load: extra arguments for dns/server.py")
+    args = p.parse_args()
+
+    tmp = tempfile.TemporaryDirectory(prefix="dns-bench")
+    if not args.configured_db:
+        os.environ.pop("DB_NAME", None)
+        os.environ["DB_SQLITE_PATH"] = os.path.join(tmp.name, "db.sqlite3")
+        os.environ["DNS_CONTAINER_DOMAIN"] = DOMAIN
+        os.environ["DNS_MIRROR_SERVER"] = ""
+
+    sys.path.insert(0, HERE)
+    import server  # noqa: E402
+
+    if not args.configured_db:
+        from django.core.management import call_command
+        call_command("migrate", verbosity=0)
+        seed(args.containers, args.extras)
+
+    if args.mode == "db":
+        bench_db(server, args)
+    else:
+        from django.db import connections
+        connections.close_all()
+        bench_load(args, server.settings.DNS_CONTAINER_DOMAIN, dict(os.environ))
+    tmp.cleanup()
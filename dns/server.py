@@ -7,14 +7,18 @@
 
 from __future__ import print_function
 
-from dnslib import RR, parse_time, QTYPE, RCODE, A, AAAA
+from dnslib import RR, parse_time, QTYPE, RCODE
 from dnslib.label import DNSLabel
-from dnslib.server import DNSServer, DNSHandler, BaseResolver, DNSLogger
-from dnslib.dns import DNSRecord
+from dnslib.server import DNSServer, DNSHandler, BaseResolver, DNSLogger, TCPServer, UDPServer
 
 import sys
 import os
 import json
+import select
+import signal
+import socket
+import threading
+import time
 from datetime import datetime
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ct_backend.settings")
@@ -23,10 +27,26 @@ sys.path.append(os.path.abspath(__file__ + "/../../"))
 import django  # noqa: F402
 django.setup()
 
-from apps.container.models import Container  # noqa: F402
-from apps.dns.models import ZoneExtra, DynamicEntry  # noqa: F402
+from apps.dns import notify  # noqa: F402
+from apps.dns.aioserver import AsyncDNSServer  # noqa: F402
+from apps.dns.cache import ResponseCache  # noqa: F402
+from apps.dns.forwarder import AsyncForwarder, Forwarder  # noqa: F402
+from apps.dns.wire import AnswerTemplates  # noqa: F402
+from apps.dns.zone import ContainerIndex, ZoneIndex  # noqa: F402
 from django.conf import settings  # noqa: F402
-from django.db import connections
+from django.db import InterfaceError, OperationalError, connection, connections  # noqa: F402
+
+
+class ReusePortUDPServer(UDPServer):
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class ReusePortTCPServer(TCPServer):
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
 
 class LXDResolver(BaseResolver):
@@ -35,88 +55,367 @@ class LXDResolver(BaseResolver):
         self.origin = DNSLabel(origin)
         self.ttl = parse_time(ttl)
         self.routes = {}
+        self.zone = ZoneIndex(origin)
+        self.containers = ContainerIndex()
+        self._containers_changed = threading.Event()
+        # bumped whenever the served data changed, together with the data under `lock`
+        self.generation = 0
+        self.lock = threading.Lock()
+        self._authority = None
+        self.templates = AnswerTemplates(settings.DNS_TEMPLATE_SIZE)
+        self.forwarder = None
+        self.async_forwarder = None
+        self.cache = ResponseCache(settings.DNS_CACHE_SIZE, settings.DNS_CACHE_MAX_TTL)
+        if settings.DNS_MIRROR_SERVERS:
+            self.forwarder = Forwarder(settings.DNS_MIRROR_SERVERS, settings.DNS_FORWARD_TIMEOUT)
+            self.async_forwarder = AsyncForwarder(settings.DNS_MIRROR_SERVERS, settings.DNS_FORWARD_TIMEOUT)
+        self.db(self.zone.rebuild)
+        self.db(self.containers.rebuild)
+        # the serving threads never use the database, forked workers open their own connections
+        connections.close_all()
 
-    def resolve(self, request, handler):
+    def db(self, fn, *args):
+        """
+        run fn on this thread's persistent database connection. The connection
+        is health checked before use and re-established once if it broke.
+        """
+        for retry in (False, True):
+            try:
+                if connection.connection is not None and not connection.is_usable():
+                    print("database connection unusable, reconnecting")
+                    connection.close()
+                return fn(*args)
+            except (InterfaceError, OperationalError) as e:
+                connection.close()
+                if retry:
+                    raise
+                print("database error, reconnecting:", e)
+
+    def update(self, fn, *args):
+        """
+        run the index update fn, which returns whether it changed the data, and
+        start a new generation if it did. Updates of the different threads and
+        their generations are applied one at a time.
+        """
+        with self.lock:
+            if self.db(fn, *args):
+                self.generation += 1
+
+    def refresh(self, interval):
+        """
+        periodically rebuild the zone index, runs in its own thread
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                # only a change of the data starts a new generation, it drops the templates
+                self.update(self.zone.rebuild)
+                self.update(self.containers.rebuild)
+            except Exception as e:
+                print("zone refresh failed:", e)
+
+    def refresh_containers(self):
+        """
+        rebuild the container answers after changes, runs in its own thread.
+        Changes arriving within a few milliseconds are applied together.
+        """
+        while True:
+            self._containers_changed.wait()
+            time.sleep(0.05)
+            self._containers_changed.clear()
+            try:
+                self.update(self.containers.rebuild)
+            except Exception as e:
+                print("container refresh failed:", e)
+                self._containers_changed.set()
+                time.sleep(1)
+
+    def apply_change(self, model, pk, action):
+        """
+        callback of the change notification channel
+        """
+        try:
+            if model in ("zoneextra", "dynamicentry"):
+                self.update(self.zone.update, model, pk)
+            elif model in ("container", "ip", "host"):
+                self._containers_changed.set()
+            elif model == "*":
+                self.update(self.zone.rebuild)
+                self._containers_changed.set()
+        except Exception as e:
+            print("applying change %s:%s:%s failed:" % (model, pk, action), e)
+
+    def print_stats(self, signum=None, frame=None):
+        print("%d response cache:" % os.getpid(), self.cache.stats())
+
+    def start_updates(self):
+        """
+        keep the data current with the refresh threads, changes go to apply_change
+        """
+        threading.Thread(target=self.refresh, args=(settings.DNS_ZONE_REFRESH,), daemon=True).start()
+        threading.Thread(target=self.refresh_containers, daemon=True).start()
+
+    def relative(self, qname):
+        """
+        the name relative to the origin, None if it is not in our zone
+        """
+        suffix = DNSLabel(self.origin)
+        if str(qname.label[-len(suffix.label):]).lower() == str(suffix.label).lower():
+            return DNSLabel(qname.label[:-len(suffix.label)])
+        return None
+
+    def answer(self, request, rem):
+        """
+        reply with the local records of a name in our zone
+        """
         reply = request.reply()
         qname = request.q.qname
         qtype = request.q.qtype
+        print("queries for :", rem, qtype)
 
-        suffix = DNSLabel(self.origin)
-        if str(qname.label[-len(suffix.label):]).lower() == str(suffix.label).lower():
-            rem = DNSLabel(qname.label[:-len(suffix.label)])
-            print("queries for :", rem, qtype)
-
-            found_rrs = []
-            found_glob = []
-            rrs = []
-            for extra in ZoneExtra.objects.all():
-                rrs += RR.fromZone(extra.entry)
-            for dyn in DynamicEntry.objects.all():
-                rrs += RR.fromZone(dyn.combined)
-            for rr in rrs:
-                if rem == rr.rname and rr.rtype in [qtype, QTYPE.CNAME]:
-                    rr.rname.label += self.origin.label
-                    found_rrs.append(rr)
-                elif rem.matchGlob(rr.rname) and rr.rtype in [qtype, QTYPE.CNAME]:
-                    rr.rname.label += self.origin.label
-                    found_glob.append(rr)
-
-
-            if len(found_rrs):
-                reply.add_answer(*found_rrs)
-            elif len(found_glob):
-                for g in found_glob:
-                    g.set_rname(qname)
-                reply.add_answer(*found_glob)
-
-            cts = Container.objects.filter(name=str(str(rem)[:-1]).lower())
-            if cts.exists():
-                ct = cts.first()
-                
-                if request.q.qtype == QTYPE.A:
-                    for ip in ct.ip_set.all():
-                        if ip.is_ipv4:
-                            reply.add_answer(RR(qname, QTYPE.A, ttl=self.ttl,
-                                                rdata=A(ip.ip)))
-                        elif ip.siit_ip.exists():
-                            reply.add_answer(RR(qname, QTYPE.A, ttl=self.ttl,
-                                                rdata=A(ip.siit_ip.first().ip)))
-                if request.q.qtype == QTYPE.AAAA:
-                    for ip in ct.ip_set.all():
-                        if not ip.is_ipv4:
-                            reply.add_answer(RR(qname, QTYPE.AAAA, ttl=self.ttl,
-                                                rdata=AAAA(ip.ip)))
-            # try other server
-            if len(reply.rr) == 0 and (settings.DNS_MIRROR_SERVER is not None):
-                print("checking other server because no rr and env: .%s. "%settings.DNS_MIRROR_SERVER)
-                connections.close_all()  # might fail
-                apk = request.send(settings.DNS_MIRROR_SERVER, 53, timeout=30)
-                reply = DNSRecord.parse(apk)
-
-            if len(reply.rr) == 0:
-                reply.header.rcode = RCODE.NOERROR
-                now = datetime.now()
-                soatime = now.strftime('%y%j')+"%05d"%(now.hour*3600+now.minute*60+now.second)
-                reply.add_auth(*RR.fromZone(f"{self.origin} 60 IN SOA {settings.DNS_BASE_DOMAIN} non-exist.{settings.DNS_BASE_DOMAIN} {soatime} 900 900 1800 60"))
-            else:
-                reply.add_auth(*RR.fromZone(f"{self.origin} 60 IN NS {settings.DNS_BASE_DOMAIN}"))
+        found_rrs, found_glob = self.zone.lookup(rem, qtype)
+
+        if len(found_rrs):
+            reply.add_answer(*found_rrs)
+        elif len(found_glob):
+            reply.add_answer(*[RR(qname, g.rtype, g.rclass, g.ttl, g.rdata) for g in found_glob])
+
+        answers = self.containers.lookup(str(str(rem)[:-1]).lower())
+        if answers is not None:
+            if qtype == QTYPE.A:
+                reply.add_answer(*[RR(qname, QTYPE.A, ttl=self.ttl, rdata=rdata) for rdata in answers[0]])
+            if qtype == QTYPE.AAAA:
+                reply.add_answer(*[RR(qname, QTYPE.AAAA, ttl=self.ttl, rdata=rdata) for rdata in answers[1]])
+        return reply
+
+    def authority(self):
+        """
+        the SOA and NS records, built once per data generation
+        """
+        authority = self._authority
+        if authority is None or authority[0] != self.generation:
+            now = datetime.now()
+            soatime = now.strftime('%y%j')+"%05d"%(now.hour*3600+now.minute*60+now.second)
+            authority = (self.generation,
+                         RR.fromZone(f"{self.origin} 60 IN SOA {settings.DNS_BASE_DOMAIN} non-exist.{settings.DNS_BASE_DOMAIN} {soatime} 900 900 1800 60"),
+                         RR.fromZone(f"{self.origin} 60 IN NS {settings.DNS_BASE_DOMAIN}"))
+            self._authority = authority
+        return authority[1], authority[2]
+
+    def finish(self, reply):
+        soa, ns = self.authority()
+        if len(reply.rr) == 0:
+            reply.header.rcode = RCODE.NOERROR
+            reply.add_auth(*soa)
         else:
-            reply.header.rcode = RCODE.NXDOMAIN
+            reply.add_auth(*ns)
+        return reply
 
-        connections.close_all()
+    def failed(self, request, rcode):
+        reply = request.reply()
+        reply.header.rcode = rcode
         return reply
 
+    def local(self, request):
+        """
+        the reply from local data, None if the question has to be forwarded.
+        Local replies are kept as templates for cached_reply.
+        """
+        # read before answering, a change while answering leaves a stale template unusable
+        generation = self.generation
+        rem = self.relative(request.q.qname)
+        if rem is None:
+            reply = self.failed(request, RCODE.NXDOMAIN)
+        else:
+            reply = self.answer(request, rem)
+            # try other server
+            if len(reply.rr) == 0 and self.forwarder is not None:
+                return None
+            reply = self.finish(reply)
+        self.templates.put(request, reply, generation)
+        return reply
+
+    def cached_reply(self, data):
+        """
+        the packed reply to a raw query if a template for it exists
+        """
+        return self.templates.get(data, self.generation)
+
+    def resolve(self, request, handler):
+        reply = self.local(request)
+        if reply is None:
+            reply = self.cache.get(request)
+            if reply is None:
+                reply = self.forwarder.forward(request)
+                if reply is None:
+                    return self.failed(request, RCODE.SERVFAIL)
+                self.cache.put(request, reply)
+            reply = self.finish(reply)
+        return reply
+
+    async def resolve_async(self, request):
+        reply = self.local(request)
+        if reply is None:
+            reply = self.cache.get(request)
+            if reply is None:
+                reply = await self.async_forwarder.forward(request)
+                if reply is None:
+                    return self.failed(request, RCODE.SERVFAIL)
+                self.cache.put(request, reply)
+            reply = self.finish(reply)
+        return reply
+
+
+class TemplateDNSHandler(DNSHandler):
+    """
+    answers questions with a template of the resolver without parsing them
+    """
+
+    def get_reply(self, data):
+        packet = self.server.resolver.cached_reply(data)
+        if packet is None or (self.protocol == 'udp' and self.udplen and len(packet) > self.udplen):
+            return super().get_reply(data)
+        return packet
+
+
+def serve(resolver, args, logger, reuse_port=False, ready=None):
+    """
+    serve until the process is terminated, `ready` is called once the sockets are bound
+    """
+    if args.asyncio:
+        AsyncDNSServer(resolver, address=args.address, port=args.port, tcp=args.tcp, udplen=args.udplen,
+                       reuse_port=reuse_port).serve_forever(ready=ready)
+        return
+
+    if args.udplen:
+        DNSHandler.udplen = args.udplen
+
+    udp_server = DNSServer(resolver, port=args.port, address=args.address, logger=logger, handler=TemplateDNSHandler,
+                           server=ReusePortUDPServer if reuse_port else None)
+    udp_server.start_thread()
+
+    if args.tcp:
+        tcp_server = DNSServer(resolver, port=args.port, address=args.address, tcp=True, logger=logger,
+                               handler=TemplateDNSHandler, server=ReusePortTCPServer if reuse_port else None)
+        tcp_server.start_thread()
+
+    if ready is not None:
+        ready()
+
+    while udp_server.isAlive():
+        time.sleep(1)
+
+
+def follow(resolver, fd):
+    """
+    apply the changes the supervisor relays to this worker, runs in its own thread
+    """
+    with os.fdopen(fd) as changes:
+        for line in changes:
+            resolver.apply_change(*notify.parse(line.strip()))
+    print("supervisor gone, worker %d exits" % os.getpid())
+    os._exit(0)
+
+
+def relay(workers):
+    """
+    notification callback of the supervisor, passes every change on to all workers
+    """
+    def send(model, pk, action):
+        line = ("%s:%s:%s\n" % (model, pk, action)).encode()
+        for pid, fd in list(workers.items()):
+            try:
+                os.write(fd, line)
+            except OSError as e:
+                # a stuck worker catches up with its next refresh
+                print("worker %d missed change %s:" % (pid, line.strip()), e)
+    return send
+
+
+def spawn(resolver, args, logger, workers):
+    """
+    fork a worker from the resolver data. It serves, refreshes and applies the
+    changes relayed to it on its own, so its response cache and answer templates
+    live as long as the worker. Returns its pid and the write end of its change
+    pipe once it is listening.
+    """
+    r, w = os.pipe()
+    changes_r, changes_w = os.pipe()
+    # no half applied update in the snapshot
+    with resolver.lock:
+        pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        os.close(changes_w)
+        for fd in workers.values():
+            os.close(fd)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, resolver.print_stats)
+        try:
+            resolver.start_updates()
+            threading.Thread(target=follow, args=(resolver, changes_r), daemon=True).start()
+            # anything could have changed since the supervisor loaded its data
+            resolver.apply_change(*notify.RESYNC)
+            serve(resolver, args, logger, reuse_port=True, ready=lambda: os.write(w, b"."))
+        except Exception as e:
+            print("worker failed:", e)
+        os._exit(1)
+
+    os.close(w)
+    os.close(changes_r)
+    os.set_blocking(changes_w, False)
+    if select.select([r], [], [], 10)[0]:
+        os.read(r, 1)
+    os.close(r)
+    return pid, changes_w
+
+
+def supervise(resolver, args, logger):
+    """
+    keep args.workers forked servers running on SO_REUSEPORT sockets and relay the
+    change notifications to them. The workers keep their data current themselves,
+    each with its own database connection, and are only forked again when they die.
+    SIGUSR1 is passed on, every worker prints its own cache stats.
+    """
+    # pid -> write end of the change pipe
+    workers = {}
+    for _ in range(args.workers):
+        pid, fd = spawn(resolver, args, logger, workers)
+        workers[pid] = fd
+    print("serving with %d workers" % len(workers))
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(pid, signal.SIGUSR1) for pid in list(workers)])
+    threading.Thread(target=notify.listen, args=(relay(workers),), daemon=True).start()
+
+    while True:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in workers:
+                print("worker %d died (%d), restarting" % (pid, status))
+                os.close(workers.pop(pid))
+                new, fd = spawn(resolver, args, logger, workers)
+                workers[new] = fd
+        time.sleep(0.1)
+
 
 if __name__ == '__main__':
 
     import argparse
-    import time
 
     p = argparse.ArgumentParser(description="Fixed DNS Resolver")
     p.add_argument("--port", "-p", type=int, default=53, metavar="<port>", help="Server port (default:53)")
     p.add_argument("--address", "-a", default="", metavar="<address>", help="Listen address (default:all)")
     p.add_argument("--udplen", "-u", type=int, default=0, metavar="<udplen>", help="Max UDP packet length (default:0)")
     p.add_argument("--tcp", action='store_true', default=False, help="TCP server (default: UDP only)")
+    p.add_argument("--asyncio", action='store_true', default=False,
+                   help="Serve from an asyncio loop with non-blocking forwarding (default: threaded)")
+    p.add_argument("--workers", "-w", type=int, default=1, metavar="<workers>",
+                   help="Serving processes sharing the port with SO_REUSEPORT (default:1)")
     p.add_argument("--log", default="request,reply,truncated,error",
                    help="Log hooks to enable (default: +request,+reply,+truncated,+error,-recv,-send,-data)")
     p.add_argument("--log-prefix", action='store_true', default=False,
@@ -126,21 +425,19 @@ if __name__ == '__main__':
     resolver = LXDResolver(settings.DNS_CONTAINER_DOMAIN, '60s')
     logger = DNSLogger(args.log, args.log_prefix)
 
-    print("Starting Fixed Resolver (%s:%d) [%s]" % (args.address or "*", args.port, "UDP/TCP" if args.tcp else "UDP"))
+
+    print("Starting Fixed Resolver (%s:%d) [%s]%s" % (args.address or "*", args.port, "UDP/TCP" if args.tcp else "UDP",
+                                                    " asyncio" if args.asyncio else ""))
 
     # for rr in resolver.rrs:
     #     print("    | ", rr.toZone().strip(), sep="")
     # print()
 
-    if args.udplen:
-        DNSHandler.udplen = args.udplen
-
-    udp_server = DNSServer(resolver, port=args.port, address=args.address, logger=logger)
-    udp_server.start_thread()
-
-    if args.tcp:
-        tcp_server = DNSServer(resolver, port=args.port, address=args.address, tcp=True, logger=logger)
-        tcp_server.start_thread()
-
-    while udp_server.isAlive():
-        time.sleep(1)
+    # with workers only the notification listener stays in this process, see supervise
+    if args.workers > 1:
+        supervise(resolver, args, logger)
+    else:
+        resolver.start_updates()
+        signal.signal(signal.SIGUSR1, resolver.print_stats)
+        threading.Thread(target=notify.listen, args=(resolver.apply_change,), daemon=True).start()
+        serve(resolver, args, logger)
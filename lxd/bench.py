@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Benchmarks of the LXD tasks against fake hosts (lxd/fakelxd.py) and a freshly
+    migrated SQLite database in a temporary directory:
+
+        python lxd/bench.py sync --sizes 10,100,1000 --hosts 2 --latency 0.002
+        python lxd/bench.py actions --latency 0.002
+
+    `sync` runs synchost for hosts of each size: a cold sync which creates all
+    rows, a warm one without changes and one after --churn of the containers
+    were started or stopped. `actions` runs create_container, container_action,
+    container_migrate and delete_container once. Both report the wall time, the
+    database queries, the LXD requests and the connections they took. Everything
+    runs offline.
+"""
+
+import argparse
+import contextlib
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_request(port, method, path, body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request(method, path, body=json.dumps(body or {}), headers={"Content-Type": "application/json"})
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+@contextlib.contextmanager
+def fake_hosts(args, count, containers):
+    """
+    starts `count` fake hosts with `containers` containers each in a subprocess,
+    yields their Host rows
+    """
+    import fakelxd
+    from apps.host.models import Host, Subnet
+
+    ports = [free_port() for i in range(count)]
+    ready = multiprocessing.Event()
+    fake = multiprocessing.Process(target=fakelxd.serve, daemon=True,
+                                   args=(ports, containers, args.images, args.latency, args.failure_rate, ready))
+    fake.start()
+    if not ready.wait(60):
+        raise RuntimeError("fake lxd hosts did not come up")
+
+    subnet = Subnet.objects.get_or_create(ip="45.0.0.0", prefixlen=8)[0]
+    hosts = [Host.objects.create(name="bench-%d-%d" % (containers, i), subnet=subnet,
+                                 api_url="http://127.0.0.1:%d" % port) for i, port in enumerate(ports)]
+    try:
+        yield hosts
+    finally:
+        fake.terminate()
+        fake.join()
+
+
+def host_port(host):
+    return int(host.api_url.rsplit(":", 1)[1])
+
+
+@contextlib.contextmanager
+def measure(hosts):
+    """
+    yields a dict which receives the seconds, database queries and LXD requests of the block
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    for host in hosts:
+        fake_request(host_port(host), "POST", "/fake/reset")
+    result = {}
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        yield result
+        result["seconds"] = time.perf_counter() - start
+    result["queries"] = len(queries)
+    stats = [fake_request(host_port(host), "GET", "/fake/stats") for host in hosts]
+    result["requests"] = sum(s["requests"] for s in stats)
+    result["connections"] = sum(s["connections"] for s in stats)
+
+
+def report(title, result):
+    print("%-48s %9.3fs %8d queries %8d lxd requests %6d connections" % (
+        title, result["seconds"], result["queries"], result["requests"], result["connections"]))
+
+
+def bench_sync(args):
+    from apps.container.tasks import synchost
+
+    for size in [int(s) for s in args.sizes.split(",")]:
+        with fake_hosts(args, args.hosts, size) as hosts:
+            for title, churn in (("cold", 0), ("warm", 0), ("churn %g" % args.churn, args.churn)):
+                if churn:
+                    for host in hosts:
+                        fake_request(host_port(host), "POST", "/fake/churn", {"fraction": churn})
+                with measure(hosts) as result:
+                    for host in hosts:
+                        synchost(host.id)
+                report("%d hosts x %d containers, %s" % (len(hosts), size, title), result)
+
+
+def bench_actions(args):
+    from apps.container.models import Container, Project
+    from apps.container.tasks import container_action, container_migrate, create_container, delete_container
+    from apps.container.tasks import synchost
+
+    size = int(args.sizes.split(",")[0])
+    with fake_hosts(args, 2, size) as hosts:
+        for host in hosts:
+            synchost(host.id)
+        project = Project.objects.create(name="bench")
+        ct = Container.objects.create(name="bench-new", host=hosts[0], project=project,
+                                      state=json.dumps({'status': 'Created', 'status_code': 114}),
+                                      config=json.dumps({"source": {"fingerprint": "bench"}}))
+
+        with measure(hosts) as result:
+            create_container(ct.id)
+        report("create_container (with host key generation)", result)
+
+        for action in ("start", "stop"):
+            with measure(hosts) as result:
+                container_action(ct.id, action)
+            report("container_action %s" % action, result)
+
+        ct.host = hosts[1]
+        ct.save()
+        with measure(hosts) as result:
+            container_migrate(ct.id, hosts[0].id)
+        report("container_migrate", result)
+
+        with measure(hosts) as result:
+            delete_container(ct.id)
+        report("delete_container", result)
+
+
+if __name__ == '__main__':
+
+    p = argparse.ArgumentParser(description="LXD task benchmarks against fake hosts")
+    p.add_argument("mode", choices=["sync", "actions"],
+                   help="sync: synchost per host size, actions: the single container tasks")
+    p.add_argument("--sizes", default="10,100,1000", help="Containers per host, comma separated (default:10,100,1000)")
+    p.add_argument("--hosts", type=int, default=1, help="sync: hosts per size (default:1)")
+    p.add_argument("--images", type=int, default=5, help="Images per host (default:5)")
+    p.add_argument("--churn", type=float, default=0.1, help="sync: share of containers changing state (default:0.1)")
+    p.add_argument("--latency", type=float, default=0.0, help="Seconds added to every LXD request (default:0)")
+    p.add_argument("--failure-rate", type=float, default=0.0, help="Share of LXD requests failing (default:0)")
+    args = p.parse_args()
+
+    tmp = tempfile.TemporaryDirectory(prefix="lxd-bench")
+    os.environ.pop("DB_NAME", None)
+    os.environ["DB_SQLITE_PATH"] = os.path.join(tmp.name, "db.sqlite3")
+    os.environ["LXD_LOCK_URL"] = "memory://"
+    os.environ["LXD_CA_CERT"] = "False"
+    os.environ["DNS_NOTIFY_ADDRESS"] = "127.0.0.1:%d" % free_port()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ct_backend.settings")
+    sys.path.insert(0, HERE)
+    sys.path.append(os.path.dirname(HERE))
+
+    import django  # noqa: E402
+    django.setup()
+
+    from django.core.management import call_command  # noqa: E402
+    call_command("migrate", verbosity=0)
+
+    if args.mode == "sync":
+        bench_sync(args)
+    else:
+        bench_actions(args)
+    tmp.cleanup()
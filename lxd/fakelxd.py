@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Stand-in for LXD hosts: serves the parts of the /1.0 REST API the tasks use
+    (server info, containers with state and recursion, state changes, create,
+    delete, migration, images, operations) from memory over plain HTTP, one
+    port per simulated host:
+
+        python lxd/fakelxd.py --hosts 3 --containers 500 --port 18443 --latency 0.005
+
+    Every request is delayed by --latency seconds and fails with a 500 with a
+    probability of --failure-rate. Besides the LXD API every host serves
+    GET /fake/stats (request and connection counts, reset with POST /fake/reset) and
+    POST /fake/churn {"fraction": 0.1} which starts or stops that share of its containers.
+"""
+
+import argparse
+import collections
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_EXTENSIONS = ["storage", "network", "profile_usedby", "container_push", "container_stateful_migration",
+                  "container_only_migration", "container_full", "container_migrate_with_snapshots"]
+
+# port -> FakeHost, migrations pull from another host of the same process
+HOSTS = {}
+
+
+def now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000000Z", time.gmtime())
+
+
+class LXDError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeHost(object):
+    """
+    containers, images and operations of one simulated host
+    """
+
+    def __init__(self, index, port, containers, images, latency=0.0, failure_rate=0.0):
+        self.index = index
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.RLock()
+        self.requests = collections.Counter()
+        self.connections = 0
+        self.containers = {}
+        self.images = {}
+        self.operations = {}
+        self.random = random.Random(index)
+        for i in range(containers):
+            self.add_container("ct%d-%d" % (index, i), running=self.random.random() < 0.8)
+        for i in range(images):
+            self.add_image("image%d" % i)
+
+    def add_container(self, name, running=True, config=None):
+        n = len(self.containers) + 1
+        self.containers[name] = {
+            "name": name,
+            "running": running,
+            "config": dict(config or {"security.nesting": "false", "user.vendor-data": "#cloud-config"}),
+            "ipv4": "45.%d.%d.%d" % (self.index & 255, n >> 8 & 255, n & 255),
+            "ipv6": "2a0a:e5c0:%x::%x" % (self.index, n),
+            "created_at": now(),
+        }
+
+    def add_image(self, alias):
+        fingerprint = uuid.uuid4().hex + uuid.uuid4().hex
+        self.images[fingerprint] = {
+            "aliases": [{"name": alias, "description": ""}],
+            "architecture": "x86_64",
+            "auto_update": True,
+            "cached": False,
+            "created_at": now(),
+            "expires_at": now(),
+            "filename": "%s.tar.xz" % alias,
+            "fingerprint": fingerprint,
+            "last_used_at": now(),
+            "properties": {"description": alias, "os": "ubuntu", "release": "focal"},
+            "public": False,
+            "size": 100000000,
+            "uploaded_at": now(),
+            "update_source": None,
+        }
+        return fingerprint
+
+    def info(self):
+        return {
+            "api_extensions": API_EXTENSIONS,
+            "api_status": "stable",
+            "api_version": "1.0",
+            "auth": "trusted",
+            "auth_methods": ["tls"],
+            "public": False,
+            "config": {},
+            "environment": {
+                "addresses": ["127.0.0.1:%d" % self.port],
+                "architectures": ["x86_64"],
+                "certificate": "fake certificate of host %d" % self.index,
+                "certificate_fingerprint": "%064x" % self.index,
+                "driver": "lxc",
+                "driver_version": "4.0.0",
+                "kernel": "Linux",
+                "kernel_architecture": "x86_64",
+                "kernel_version": "5.4.0",
+                "server": "lxd",
+                "server_pid": 1,
+                "server_version": "4.0.0",
+                "storage": "dir",
+                "storage_version": "1",
+            },
+        }
+
+    def container(self, name):
+        ct = self.containers.get(name)
+        if ct is None:
+            raise LXDError(404, "not found")
+        status, code = ("Running", 103) if ct["running"] else ("Stopped", 102)
+        return {
+            "architecture": "x86_64",
+            "config": ct["config"],
+            "created_at": ct["created_at"],
+            "description": "",
+            "devices": {},
+            "ephemeral": False,
+            "expanded_config": ct["config"],
+            "expanded_devices": {"eth0": {"name": "eth0", "network": "lxdbr0", "type": "nic"}},
+            "last_used_at": ct["created_at"],
+            "location": "none",
+            "name": name,
+            "profiles": ["default"],
+            "stateful": False,
+            "status": status,
+            "status_code": code,
+        }
+
+    def state(self, name):
+        ct = self.containers.get(name)
+        if ct is None:
+            raise LXDError(404, "not found")
+        if not ct["running"]:
+            return {"status": "Stopped", "status_code": 102, "disk": {}, "memory": {"usage": 0, "usage_peak": 0,
+                    "swap_usage": 0, "swap_usage_peak": 0}, "network": None, "pid": 0, "processes": 0,
+                    "cpu": {"usage": 0}}
+        # the usage counters move on every request, like on a real host
+        counters = {"bytes_received": self.random.randrange(1 << 30), "bytes_sent": self.random.randrange(1 << 30),
+                    "packets_received": self.random.randrange(1 << 20), "packets_sent": self.random.randrange(1 << 20)}
+        return {
+            "status": "Running",
+            "status_code": 103,
+            "disk": {},
+            "memory": {"usage": self.random.randrange(1 << 28, 1 << 30), "usage_peak": 1 << 30,
+                       "swap_usage": 0, "swap_usage_peak": 0},
+            "network": {
+                "eth0": {
+                    "addresses": [
+                        {"family": "inet", "address": ct["ipv4"], "netmask": "24", "scope": "global"},
+                        {"family": "inet6", "address": ct["ipv6"], "netmask": "64", "scope": "global"},
+                        {"family": "inet6", "address": "fe80::1", "netmask": "64", "scope": "link"},
+                    ],
+                    "counters": counters,
+                    "hwaddr": "00:16:3e:00:00:01",
+                    "host_name": "veth%s" % ct["name"],
+                    "mtu": 1500,
+                    "state": "up",
+                    "type": "broadcast",
+                },
+                "lo": {
+                    "addresses": [{"family": "inet", "address": "127.0.0.1", "netmask": "8", "scope": "local"}],
+                    "counters": counters,
+                    "hwaddr": "",
+                    "host_name": "",
+                    "mtu": 65536,
+                    "state": "up",
+                    "type": "loopback",
+                },
+            },
+            "pid": 1000 + len(ct["name"]),
+            "processes": self.random.randrange(10, 100),
+            "cpu": {"usage": self.random.randrange(1 << 40)},
+        }
+
+    def operation(self, resources, metadata=None, failure=None):
+        op_id = str(uuid.uuid4())
+        op = {
+            "id": op_id,
+            "class": "task",
+            "description": "fake operation",
+            "created_at": now(),
+            "updated_at": now(),
+            "status": "Failure" if failure else "Success",
+            "status_code": 400 if failure else 200,
+            "resources": resources,
+            "metadata": metadata,
+            "may_cancel": False,
+            "err": failure or "",
+            "location": "none",
+        }
+        self.operations[op_id] = op
+        return op
+
+    def churn(self, fraction):
+        names = sorted(self.containers)
+        for name in self.random.sample(names, int(len(names) * fraction)):
+            self.containers[name]["running"] = not self.containers[name]["running"]
+        return len(names)
+
+
+def sync(metadata):
+    return 200, {"type": "sync", "status": "Success", "status_code": 200, "error_code": 0, "error": "",
+                 "metadata": metadata}
+
+
+def async_(op):
+    return 202, {"type": "async", "status": "Operation created", "status_code": 100, "error_code": 0, "error": "",
+                 "operation": "/1.0/operations/%s" % op["id"], "metadata": op}
+
+
+def containers(host, method, query, body):
+    recursion = int(query.get("recursion", ["0"])[0])
+    if method == "GET":
+        if recursion == 0:
+            return sync(["/1.0/containers/%s" % name for name in sorted(host.containers)])
+        listing = []
+        for name in sorted(host.containers):
+            ct = host.container(name)
+            if recursion > 1:
+                ct["state"] = host.state(name)
+                ct["snapshots"] = None
+            listing.append(ct)
+        return sync(listing)
+
+    # create, from an image or by pulling a migration
+    name = body["name"]
+    if name in host.containers:
+        raise LXDError(409, "container %s already exists" % name)
+    source = body.get("source", {})
+    if source.get("type") == "migration":
+        url = urlparse(source["operation"])
+        origin = HOSTS.get(url.port)
+        op = origin.operations.get(url.path.rsplit("/", 1)[-1]) if origin is not None else None
+        if op is None or "migrate" not in op:
+            raise LXDError(400, "unknown migration source")
+        with origin.lock:
+            moved = origin.containers.pop(op["migrate"])
+        host.containers[name] = dict(moved, running=False)
+    else:
+        host.add_container(name, running=False, config=body.get("config"))
+    return async_(host.operation({"containers": ["/1.0/containers/%s" % name]}))
+
+
+def container(host, method, query, body, name):
+    if method == "GET":
+        return sync(host.container(name))
+    host.container(name)
+    resources = {"containers": ["/1.0/containers/%s" % name]}
+    if method == "DELETE":
+        del host.containers[name]
+        return async_(host.operation(resources))
+    if method == "POST" and body.get("migration"):
+        op = host.operation(resources, metadata={"control": uuid.uuid4().hex, "fs": uuid.uuid4().hex})
+        op["migrate"] = name
+        return async_(op)
+    if method == "POST" and body.get("name"):
+        host.containers[body["name"]] = dict(host.containers.pop(name), name=body["name"])
+        return async_(host.operation(resources))
+    if method in ("PUT", "PATCH"):
+        host.containers[name]["config"].update(body.get("config") or {})
+        return async_(host.operation(resources))
+    raise LXDError(400, "unsupported")
+
+
+def container_state(host, method, query, body, name):
+    if method == "GET":
+        return sync(host.state(name))
+    ct = host.containers.get(name)
+    if ct is None:
+        raise LXDError(404, "not found")
+    action = body.get("action")
+    if action not in ("start", "stop", "restart", "freeze", "unfreeze"):
+        raise LXDError(400, "unknown action %s" % action)
+    if action == "start" and ct["running"]:
+        return async_(host.operation({"containers": ["/1.0/containers/%s" % name]},
+                                     failure="The container is already running"))
+    ct["running"] = action in ("start", "restart", "unfreeze")
+    return async_(host.operation({"containers": ["/1.0/containers/%s" % name]}))
+
+
+def container_exec(host, method, query, body, name):
+    if name not in host.containers:
+        raise LXDError(404, "not found")
+    return async_(host.operation({"containers": ["/1.0/containers/%s" % name]},
+                                 metadata={"return": 0, "output": {}, "fds": {}}))
+
+
+def images(host, method, query, body):
+    if method == "GET":
+        if int(query.get("recursion", ["0"])[0]):
+            return sync([host.images[fp] for fp in sorted(host.images)])
+        return sync(["/1.0/images/%s" % fp for fp in sorted(host.images)])
+    alias = ((body.get("aliases") or [{}])[0].get("name") or body.get("source", {}).get("alias") or "pulled")
+    fingerprint = host.add_image(alias)
+    return async_(host.operation({"images": ["/1.0/images/%s" % fingerprint]}, metadata={"fingerprint": fingerprint}))
+
+
+def image(host, method, query, body, fingerprint):
+    if fingerprint not in host.images:
+        raise LXDError(404, "not found")
+    if method == "DELETE":
+        del host.images[fingerprint]
+        return async_(host.operation({"images": ["/1.0/images/%s" % fingerprint]}))
+    return sync(host.images[fingerprint])
+
+
+def image_alias(host, method, query, body, alias):
+    for image in host.images.values():
+        if any(a["name"] == alias for a in image["aliases"]):
+            return sync({"name": alias, "description": "", "target": image["fingerprint"], "type": "container"})
+    raise LXDError(404, "not found")
+
+
+def operation(host, method, query, body, op_id, wait=None):
+    op = host.operations.get(op_id)
+    if op is None:
+        raise LXDError(404, "not found")
+    return sync(dict((k, v) for k, v in op.items() if k != "migrate"))
+
+
+def server(host, method, query, body):
+    return sync(host.info())
+
+
+def certificates(host, method, query, body):
+    return sync({})
+
+
+ROUTES = [
+    (re.compile(r"^/1\.0/?$"), server),
+    (re.compile(r"^/1\.0/certificates/?$"), certificates),
+    (re.compile(r"^/1\.0/containers/?$"), containers),
+    (re.compile(r"^/1\.0/containers/([^/]+)/?$"), container),
+    (re.compile(r"^/1\.0/containers/([^/]+)/state/?$"), container_state),
+    (re.compile(r"^/1\.0/containers/([^/]+)/exec/?$"), container_exec),
+    (re.compile(r"^/1\.0/images/?$"), images),
+    (re.compile(r"^/1\.0/images/aliases/([^/]+)/?$"), image_alias),
+    (re.compile(r"^/1\.0/images/([^/]+)/?$"), image),
+    (re.compile(r"^/1\.0/operations/([^/]+)/?$"), operation),
+    (re.compile(r"^/1\.0/operations/([^/]+)/(wait)/?$"), operation),
+]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_method(self, method):
+        host = self.server.host
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+        if url.path.startswith("/fake/"):
+            return self.reply(*self.fake(host, method, url.path, body))
+        # one handler per connection, counts the connections the clients opened
+        if not getattr(self, "counted", False):
+            self.counted = True
+            with host.lock:
+                host.connections += 1
+
+        time.sleep(host.latency)
+        for pattern, handler in ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                break
+        else:
+            return self.reply(404, {"type": "error", "error": "not found", "error_code": 404})
+
+        with host.lock:
+            host.requests["%s %s" % (method, pattern.pattern)] += 1
+        if host.random.random() < host.failure_rate:
+            return self.reply(500, {"type": "error", "error": "injected failure", "error_code": 500})
+        try:
+            with host.lock:
+                return self.reply(*handler(host, method, query, body, *match.groups()))
+        except LXDError as e:
+            return self.reply(e.code, {"type": "error", "error": str(e), "error_code": e.code})
+
+    def fake(self, host, method, path, body):
+        with host.lock:
+            if path == "/fake/stats":
+                return 200, {"requests": sum(host.requests.values()), "routes": dict(host.requests),
+                             "connections": host.connections}
+            if path == "/fake/reset":
+                host.requests.clear()
+                host.connections = 0
+                return 200, {}
+            if path == "/fake/churn":
+                return 200, {"containers": host.churn(float(body.get("fraction", 0.1)))}
+        return 404, {}
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_PATCH(self):
+        self.handle_method("PATCH")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+
+def serve(ports, containers, images, latency=0.0, failure_rate=0.0, ready=None):
+    """
+    runs one fake host per port until the process ends, sets `ready` once all listen
+    """
+    for index, port in enumerate(ports):
+        host = FakeHost(index, port, containers, images, latency, failure_rate)
+        HOSTS[port] = host
+        httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        httpd.daemon_threads = True
+        httpd.host = host
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    if ready is not None:
+        ready.set()
+    while True:
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+
+    p = argparse.ArgumentParser(description="Fake LXD hosts")
+    p.add_argument("--hosts", type=int, default=1, help="Simulated hosts (default:1)")
+    p.add_argument("--containers", type=int, default=100, help="Containers per host (default:100)")
+    p.add_argument("--images", type=int, default=5, help="Images per host (default:5)")
+    p.add_argument("--port", type=int, default=18443, help="Port of the first host, the others follow (default:18443)")
+    p.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request (default:0)")
+    p.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests failing with a 500 (default:0)")
+    args = p.parse_args()
+
+    ports = [args.port + i for i in range(args.hosts)]
+    for port in ports:
+        print("fake lxd host at http://127.0.0.1:%d" % port)
+    serve(ports, args.containers, args.images, args.latency, args.failure_rate)